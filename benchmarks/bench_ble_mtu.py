@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Measure large BLE writes and reads at different ATT MTUs.
+
+A connected BLE session writes --writes payloads of --size bytes to a
+fake peripheral, one after the other as Scratch does, then reads a value
+of the same size. Each ATT request takes --packet-time seconds on the
+fake device, like a connection interval. For each MTU in --mtus (0 for
+no exchange, the default of 23) and with and without --chunk-writes,
+report the bytes per second the device received and how many bytes a
+write without response lost because it did not fit into one packet.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from fakes import FakePeripheral, FakeBLEDevice, FakeWebSocket
+import scratch_link
+
+SERVICE = "e95d0753-251d-470a-a062-fa1922dfa9a8"
+CHARA = "e95d93ee-251d-470a-a062-fa1922dfa9a8"
+
+
+class CountingDevice(FakeBLEDevice):
+    def __init__(self, packet_time):
+        super().__init__(0, [(SERVICE, [(CHARA, 0x0e)])], packet_time)
+        self.received = 0
+
+    def on_write(self, handle, data):
+        super().on_write(handle, data)
+        self.received += len(data)
+
+
+def connect(session, perip):
+    """Connect the session as a connect request does"""
+    session.perip = perip
+    session.status = session.CONNECTED
+    session.delegate = session.BLEDelegate(session)
+    perip.withDelegate(session.delegate)
+    session.ble_thread = session.BLEThread(session)
+    session.ble_thread.daemon = True
+    session.ble_thread.start()
+    session.mtu = session.run_device(session.negotiate_mtu, perip)
+    session.run_device(session.prepare_gatt_cache)
+
+
+def measure(args, mtu, chunk_writes, with_response):
+    scratch_link.BLESession.request_mtu = mtu
+    scratch_link.BLESession.chunk_writes = chunk_writes
+    session = scratch_link.BLESession(FakeWebSocket(), asyncio.new_event_loop())
+    device = CountingDevice(args.packet_time)
+    perip = FakePeripheral(device=device)
+    connect(session, perip)
+    payload = bytes(range(256)) * (args.size // 256 + 1)
+    payload = payload[:args.size]
+
+    start = time.perf_counter()
+    for i in range(args.writes):
+        session.write_characteristic(SERVICE, CHARA, payload, with_response)
+    write_time = time.perf_counter() - start
+    write_packets = device.packets
+
+    device.values[device.handles[scratch_link.btle.UUID(CHARA)]] = payload
+    start = time.perf_counter()
+    res = session.handle_request('read', { 'serviceId': SERVICE,
+                                           'characteristicId': CHARA })
+    read_time = time.perf_counter() - start
+    session.close()
+    return {
+        'mtu': session.mtu,
+        'write_bytes_per_s': device.received / write_time,
+        'write_packets': write_packets,
+        'lost_bytes': args.writes * args.size - device.received,
+        'read_bytes_per_s': args.size / read_time if 'result' in res else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mtus", default="0,247",
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        help="MTUs to request (default: 0,247)")
+    parser.add_argument("--size", type=int, default=1024,
+                        help="bytes per write (default: 1024)")
+    parser.add_argument("--writes", type=int, default=20)
+    parser.add_argument("--packet-time", type=float, default=0.0075,
+                        help="seconds per ATT request (default: 0.0075)")
+    args = parser.parse_args()
+    scratch_link.logger.setLevel(logging.WARNING)
+    scratch_link.Session.io_backend = 'thread'
+
+    print(f"size={args.size} writes={args.writes} "
+          f"packet_time={args.packet_time * 1000:.1f}ms")
+    print(f"  {'mtu':>4s} {'chunk':>5s} {'response':>8s} {'write B/s':>10s} "
+          f"{'packets':>7s} {'lost B':>7s} {'read B/s':>9s}")
+    for mtu in args.mtus:
+        for chunk_writes in (False, True):
+            for with_response in (False, True):
+                r = measure(args, mtu, chunk_writes, with_response)
+                print(f"  {r['mtu']:4d} {'yes' if chunk_writes else 'no':>5s} "
+                      f"{'yes' if with_response else 'no':>8s} "
+                      f"{r['write_bytes_per_s']:10.0f} "
+                      f"{r['write_packets']:7d} {r['lost_bytes']:7d} "
+                      f"{r['read_bytes_per_s']:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Measure EV3 direct command throughput and latency over RFCOMM.
+
+Scratch-like send requests arrive in bursts of --burst commands every
+--interval seconds on one connected BT session. The fake RFCOMM link
+takes --link-rate bytes per second, and its socket buffers --sock-buffer
+bytes, so bursts back up as on a real link. Report the commands
+acknowledged per second, the request latency, how many sends carried
+them, the requests refused with the send buffer full, the longest event
+loop stall, and whether the device got every command intact and in
+order. Compare --bt-send-buffer sizes, passed to scratch_link.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+
+from bench_load import percentile
+from fakes import FakeBluetoothSocket, FakeWebSocket
+import scratch_link
+
+# Length, message counter, direct command without reply, perf_counter()
+COMMAND = struct.Struct("<HHBd")
+NO_REPLY = 0x80
+
+
+class TimedWebSocket(FakeWebSocket):
+    """Keep the time each response is sent by JSON-RPC id"""
+    def __init__(self):
+        super().__init__("/scratch/bt")
+        self.answered = {}
+        self.errors = 0
+
+    async def send(self, message):
+        await super().send(message)
+        msg = json.loads(message)
+        if 'id' in msg:
+            self.answered[msg['id']] = time.perf_counter()
+            if 'error' in msg:
+                self.errors += 1
+
+
+class SlowEV3():
+    """
+    EV3 at the end of a slow RFCOMM link. A thread reads rate bytes per
+    second from the socket and checks that the commands arrive whole and
+    in order.
+    """
+    def __init__(self, peer, rate):
+        self.peer = peer
+        self.rate = rate
+        self.received = 0
+        self.commands = 0
+        self.garbled = 0
+        self.expected = 0
+        self.latency = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        buf = bytearray()
+        chunk = max(1, int(self.rate / 100))
+        while True:
+            try:
+                data = self.peer.recv(chunk)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            self.received += len(data)
+            while len(buf) >= COMMAND.size:
+                length, counter, kind, sent = COMMAND.unpack_from(buf)
+                if length != COMMAND.size - 2 or kind != NO_REPLY:
+                    self.garbled += 1
+                    return
+                # Refused commands leave gaps, but none may go back
+                if (counter - self.expected) & 0xFFFF >= 0x8000:
+                    self.garbled += 1
+                self.expected = counter + 1
+                self.commands += 1
+                self.latency.append(time.perf_counter() - sent)
+                del buf[:COMMAND.size]
+            time.sleep(len(data) / self.rate)
+
+
+async def watch_loop(stop, stalls):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - start - 0.001)
+
+
+async def run(args, server_args):
+    scratch_link.logger.setLevel(logging.CRITICAL)
+    scratch_link.configure(server_args)
+    loop = asyncio.get_running_loop()
+    ws = TimedWebSocket()
+    session = scratch_link.BTSession(ws, loop)
+    sock = FakeBluetoothSocket()
+    sock.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, args.sock_buffer)
+    sock.peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.sock_buffer)
+    device = SlowEV3(sock.peer, args.link_rate)
+    session.sock = sock
+    session.status = session.CONNECTED
+    task = asyncio.create_task(session.handle())
+    stop = asyncio.Event()
+    stalls = []
+    watcher = asyncio.create_task(watch_loop(stop, stalls))
+
+    sent = {}
+    counter = 0
+    start = time.perf_counter()
+    for burst in range(args.bursts):
+        for i in range(args.burst):
+            command = COMMAND.pack(COMMAND.size - 2, counter & 0xFFFF,
+                                   NO_REPLY, time.perf_counter())
+            message = base64.standard_b64encode(command)
+            sent[counter] = time.perf_counter()
+            ws.add_request('send', { 'message': message.decode('ascii'),
+                                     'encoding': 'base64' }, id=counter)
+            counter += 1
+        await asyncio.sleep(args.interval)
+    while len(ws.answered) < counter:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    accepted = counter - ws.errors
+    deadline = time.perf_counter() + 10
+    while device.commands < accepted and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    stop.set()
+    await watcher
+    stats = session.writer.stats()
+    latency = [ws.answered[i] - sent[i] for i in sent]
+
+    print(f"bursts={args.bursts}x{args.burst} link_rate={args.link_rate:.0f}B/s "
+          f"send_buffer={session.writer.max_bytes}B")
+    print(f"  commands/s         {accepted / elapsed:8.0f}")
+    print(f"  request p50        {percentile(latency, 50) * 1000:8.2f} ms")
+    print(f"  request p99        {percentile(latency, 99) * 1000:8.2f} ms")
+    print(f"  delivery p50       {percentile(device.latency, 50) * 1000:8.2f} ms")
+    print(f"  sends              {stats['sends']:8d} for {stats['frames']} commands")
+    print(f"  refused            {ws.errors:8d}")
+    print(f"  loop stall max     {max(stalls, default=0) * 1000:8.2f} ms")
+    print(f"  device got         {device.commands:8d} commands, "
+          f"{device.garbled} out of order or garbled")
+    ws.close_connection()
+    await asyncio.gather(task, return_exceptions=True)
+    session.close()
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bursts", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=40,
+                        help="commands sent at once (default: 40)")
+    parser.add_argument("--interval", type=float, default=0.05,
+                        help="seconds between bursts (default: 0.05)")
+    parser.add_argument("--link-rate", type=float, default=20000,
+                        help="bytes per second the link takes (default: 20000)")
+    parser.add_argument("--sock-buffer", type=int, default=4096,
+                        help="socket buffer size (default: 4096)")
+    args, rest = parser.parse_known_args()
+    server_args = scratch_link.parse_args(rest)
+    asyncio.run(run(args, server_args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Soak test session teardown with reconnecting clients.
+
+In every round, Scratch-like clients connect to ws_handler, discover and
+connect their fake micro:bit or EV3, exchange data for --hold seconds
+and close the websocket, as when a browser tab is reloaded. After each
+round, count the server threads and open file descriptors, the lowest
+of --readings readings as sockets close late. Both should
+stay flat once the thread pools have warmed up: exit with status 1 when
+they grew by more than --max-growth from the end of the --warmup-rounds
+to the last round.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import websockets
+
+from bench_load import MicrobitClient, EV3Client, Results
+from bench_load import client, make_devices, server_threads
+import scratch_link
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+async def hold(stop, seconds):
+    await asyncio.sleep(seconds)
+    stop.set()
+
+
+async def run(args, server_args):
+    scratch_link.logger.setLevel(logging.WARNING)
+    scratch_link.configure(server_args)
+    microbits, ev3s = make_devices(args)
+    supervisor = scratch_link.Session.supervisor
+    samples = []
+    async with websockets.serve(scratch_link.ws_handler, "127.0.0.1", 0,
+                                max_queue=None,
+                                **supervisor.serve_options()) as server:
+        port = server.sockets[0].getsockname()[1]
+        url = f"ws://127.0.0.1:{port}/scratch"
+        for round in range(args.rounds):
+            results = Results()
+            stop = asyncio.Event()
+            timer = asyncio.create_task(hold(stop, args.hold))
+            tasks = [client(url + "/ble", MicrobitClient, device, args,
+                            results, stop) for device in microbits]
+            tasks += [client(url + "/bt", EV3Client, device, args,
+                             results, stop) for device in ev3s]
+            await asyncio.gather(*tasks)
+            timer.cancel()
+            # Wait for the server to finish tearing the sessions down
+            deadline = time.monotonic() + args.settle
+            while supervisor.sessions and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            # Sockets and executor threads close a little after the
+            # sessions, so take the lowest of several readings
+            readings = []
+            for i in range(args.readings):
+                await asyncio.sleep(0.1)
+                readings.append((server_threads(), open_fds()))
+            sample = (min(r[0] for r in readings), min(r[1] for r in readings))
+            samples.append(sample)
+            print(f"round {round + 1:3d}: connected {results.connected:3d} "
+                  f"errors {results.errors:3d} threads {sample[0]:4d} "
+                  f"fds {sample[1]:4d}")
+    return samples, supervisor.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ble-clients", type=int, default=10)
+    parser.add_argument("--bt-clients", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--hold", type=float, default=1.0,
+                        help="seconds each client stays connected (default: 1)")
+    parser.add_argument("--settle", type=float, default=5.0,
+                        help="seconds allowed for teardown (default: 5)")
+    parser.add_argument("--warmup-rounds", type=int, default=2,
+                        help="rounds to fill the thread pools (default: 2)")
+    parser.add_argument("--readings", type=int, default=10,
+                        help="readings per round, the lowest counts "
+                        "(default: 10)")
+    parser.add_argument("--max-growth", type=int, default=2,
+                        help="allowed growth of threads and fds (default: 2)")
+    parser.add_argument("--rate", type=float, default=50)
+    parser.add_argument("--bt-rate", type=float, default=20)
+    parser.add_argument("--write-rate", type=float, default=10)
+    parser.add_argument("--scan-interval", type=float, default=0.1)
+    parser.add_argument("--inquiry-time", type=float, default=0.5)
+    parser.add_argument("--name-lookup-time", type=float, default=0.1)
+    parser.add_argument("--adapter-capacity", type=int, default=0)
+    args, rest = parser.parse_known_args()
+    server_args = scratch_link.parse_args(rest)
+
+    samples, stats = asyncio.run(run(args, server_args))
+    first = samples[min(args.warmup_rounds, len(samples)) - 1]
+    first_threads, first_fds = first
+    # A leak keeps growing, while noise does not stay up for three rounds
+    last_threads = min(threads for threads, fds in samples[-3:])
+    last_fds = min(fds for threads, fds in samples[-3:])
+    print(f"threads {first_threads} -> {last_threads}, "
+          f"fds {first_fds} -> {last_fds}, supervisor {stats}")
+    status = 0
+    if (last_threads - first_threads > args.max_growth or
+        last_fds - first_fds > args.max_growth or stats['leaked_threads']):
+        print("leak: threads or file descriptors grew")
+        status = 1
+    sys.stdout.flush()
+    os._exit(status)
+
+
+if __name__ == "__main__":
+    main()
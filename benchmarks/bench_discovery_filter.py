@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for matching scan entries against discovery filters.
+
+Synthetic advertisements with a mix of 16-bit and 128-bit services,
+names and manufacturer data are matched against the filters the micro:bit
+extension and a few other Scratch extensions use.
+"""
+
+import argparse
+import random
+import time
+
+from fakes import FakeAdvertiser
+import scratch_link
+
+FILTERS = [
+    { 'services': [0xf005] },
+    { 'namePrefix': "BBC micro:bit" },
+    { 'name': "WeDo", 'services': ["00001523-1212-efde-1523-785feabcd123"] },
+    { 'manufacturerData': { '919': { 'dataPrefix': [0x00, 0x20],
+                                     'mask': [0x00, 0xff] } } },
+]
+
+SERVICES = [0xf005, 0x180d, 0x180f, "00001523-1212-efde-1523-785feabcd123",
+            "e95d93af-251d-470a-a062-fa1922dfa9a8"]
+NAMES = ["BBC micro:bit [zogev]", "WeDo", "LEGO Hub", "Phone", "Headset"]
+
+
+def scan_entries(count, seed=1):
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        manufacturer = None
+        if rng.random() < 0.3:
+            manufacturer = bytes([0x97, 0x03, rng.randrange(256), 0x20, 0x01])
+        adv = FakeAdvertiser(f"c0:00:00:00:{i // 256:02x}:{i % 256:02x}",
+                             rng.choice(NAMES),
+                             rng.sample(SERVICES, rng.randrange(3)),
+                             manufacturer=manufacturer)
+        entries.append(adv.scan_entry())
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    entries = scan_entries(args.entries)
+    start = time.perf_counter()
+    discovery_filter = scratch_link.DiscoveryFilter(FILTERS)
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(args.rounds):
+        matched = sum(1 for dev in entries if discovery_filter.matches(dev))
+    elapsed = time.perf_counter() - start
+    total = args.entries * args.rounds
+    print(f"entries={args.entries} rounds={args.rounds} filters={len(FILTERS)}")
+    print(f"  compile      {compile_time * 1e6:10.1f} us")
+    print(f"  matched      {matched:10d} per round")
+    print(f"  per entry    {elapsed / total * 1e6:10.2f} us")
+    print(f"  throughput   {total / elapsed:10.0f} entries/s")
+
+
+if __name__ == "__main__":
+    main()
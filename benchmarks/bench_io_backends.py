@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Compare the thread and asyncio device I/O backends.
+
+Many connected BLE sessions receive notifications from fake peripherals
+at a fixed rate. Report the number of threads and the latency from the
+device notification to the websocket send.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import struct
+import threading
+import time
+
+from fakes import FakeWebSocket, FakePeripheral
+import scratch_link
+
+HANDLE = 0x25
+
+
+class LatencyWebSocket(FakeWebSocket):
+    def __init__(self, latencies):
+        super().__init__()
+        self.latencies = latencies
+
+    async def send(self, message):
+        now = time.perf_counter()
+        msg = json.loads(message)
+        if msg.get('method') == 'characteristicDidChange':
+            data = base64.standard_b64decode(msg['params']['message'])
+            [sent] = struct.unpack("<d", data)
+            self.latencies.append(now - sent)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def feed(peripherals, rate, stop):
+    """Push timestamped notifications from every peripheral at rate Hz"""
+    interval = 1.0 / rate
+    next_time = time.perf_counter()
+    while not stop.is_set():
+        for perip in peripherals:
+            perip.push_notification(HANDLE,
+                                    struct.pack("<d", time.perf_counter()))
+        next_time += interval
+        time.sleep(max(0, next_time - time.perf_counter()))
+
+
+async def run(args):
+    scratch_link.logger.setLevel(logging.WARNING)
+    scratch_link.Session.io_backend = args.io_backend
+    loop = asyncio.get_running_loop()
+    latencies = []
+    sessions = []
+    tasks = []
+    for i in range(args.sessions):
+        ws = LatencyWebSocket(latencies)
+        session = scratch_link.BLESession(ws, loop)
+        session.perip = FakePeripheral(addr=f"f0:00:00:00:{i // 256:02x}:{i % 256:02x}")
+        session.status = session.CONNECTED
+        session.delegate = session.BLEDelegate(session)
+        session.delegate.add_handle(0xf005, "5261da01-fa7e-42ab-850b-7c80220097cc",
+                                    HANDLE)
+        session.perip.withDelegate(session.delegate)
+        if args.io_backend == 'asyncio':
+            session.add_helper_reader()
+        else:
+            thread = session.BLEThread(session)
+            thread.daemon = True
+            thread.start()
+        sessions.append(session)
+        tasks.append(asyncio.create_task(session.handle()))
+
+    stop = threading.Event()
+    feeder = threading.Thread(target=feed, args=(
+        [s.perip for s in sessions], args.rate, stop))
+    feeder.start()
+    await asyncio.sleep(args.duration / 2)
+    threads = threading.active_count()
+    await asyncio.sleep(args.duration / 2)
+    stop.set()
+    feeder.join()
+
+    for session in sessions:
+        session.websocket.close_connection()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for session in sessions:
+        session.close()
+
+    print(f"io_backend={args.io_backend} sessions={args.sessions} "
+          f"rate={args.rate}/s duration={args.duration}s")
+    print(f"  threads        {threads:8d}")
+    print(f"  notifications  {len(latencies):8d}")
+    print(f"  latency p50    {percentile(latencies, 50) * 1000:8.2f} ms")
+    print(f"  latency p99    {percentile(latencies, 99) * 1000:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--io-backend", choices=scratch_link.Session.IO_BACKENDS,
+                        default='asyncio')
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=5)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+Load test scratch_link with simulated devices.
+
+Scratch-like websocket clients connect to ws_handler over a local
+websocket server. Each BLE client discovers its own fake micro:bit,
+connects, starts accelerometer notifications and writes to the display
+at --write-rate. Each BT client discovers its own fake EV3, connects and
+sends commands at --write-rate while the brick streams reply frames.
+With --adapters 0,1,2 the micro:bits are reached through simulated HCI
+adapters, each accepting --adapter-capacity connections.
+
+Report notification throughput and latency from the device to the
+client, request latency, the peak number of threads and memory. Options
+not listed here are passed to scratch_link, e.g. --io-backend asyncio.
+Save a report with --save and compare a later run against it with
+--baseline to catch regressions.
+"""
+
+import argparse
+import asyncio
+import base64
+import functools
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import websockets
+
+import fakes
+from fakes import FakeMicrobit, FakeEV3, FakeDeviceDiscoverer, FakeScanner
+from fakes import FakePeripheral
+fakes.install()
+import scratch_link
+
+MICROBIT_SERVICE = 0xf005
+EV3_FRAME = struct.Struct("<HHBd")
+
+# Lower is better for these, higher for the others
+LOWER_IS_BETTER = ('notify_p50_ms', 'notify_p99_ms', 'request_p50_ms',
+                   'request_p99_ms', 'discover_p50_ms', 'discover_max_ms',
+                   'threads', 'rss_mb')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Results():
+    """Samples taken by all clients while recording"""
+    def __init__(self):
+        self.recording = False
+        self.notify_latency = []
+        self.request_latency = []
+        self.discover_time = []
+        self.connected = 0
+        self.errors = 0
+
+
+class ScratchClient():
+    """JSON-RPC client behaving like the Scratch GUI for one session"""
+    def __init__(self, ws, results):
+        self.ws = ws
+        self.results = results
+        self.next_id = 0
+        self.pending = {}
+        self.discovered = asyncio.Queue()
+
+    async def read(self):
+        async for message in self.ws:
+            msg = json.loads(message)
+            if 'id' in msg:
+                future = self.pending.pop(msg['id'], None)
+                if future and not future.done():
+                    future.set_result(msg)
+            elif msg['method'] == 'didDiscoverPeripheral':
+                self.discovered.put_nowait(msg['params'])
+            elif msg['method'] in ('characteristicDidChange',
+                                   'didReceiveMessage'):
+                self.on_data(base64.standard_b64decode(
+                    msg['params']['message']), time.perf_counter())
+
+    def on_data(self, data, now):
+        pass
+
+    async def call(self, method, params):
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        start = time.perf_counter()
+        await self.ws.send(json.dumps({ 'jsonrpc': '2.0', 'id': self.next_id,
+                                        'method': method, 'params': params }))
+        res = await future
+        if self.results.recording:
+            self.results.request_latency.append(time.perf_counter() - start)
+        if 'error' in res:
+            raise RuntimeError(f"{method} failed: {res['error']}")
+        return res.get('result')
+
+    async def find(self, name, start):
+        while True:
+            params = await self.discovered.get()
+            if params['name'] == name:
+                self.results.discover_time.append(time.perf_counter() - start)
+                return params['peripheralId']
+
+
+class MicrobitClient(ScratchClient):
+    def on_data(self, data, now):
+        if self.results.recording and len(data) >= 18:
+            [sent] = struct.unpack_from("<d", data, 10)
+            self.results.notify_latency.append(now - sent)
+
+    async def session(self, device, write_rate, stop):
+        start = time.perf_counter()
+        await self.call('discover', { 'filters': [
+            { 'services': [MICROBIT_SERVICE] }] })
+        peripheral_id = await self.find(device.advertiser.name, start)
+        await self.call('connect', { 'peripheralId': peripheral_id })
+        await self.call('read', { 'serviceId': MICROBIT_SERVICE,
+                                  'characteristicId': device.RX_CHARA,
+                                  'startNotifications': True })
+        self.results.connected += 1
+        message = base64.standard_b64encode(b"\x81Hello").decode('ascii')
+        while not stop.is_set():
+            await self.call('write', { 'serviceId': MICROBIT_SERVICE,
+                                       'characteristicId': device.TX_CHARA,
+                                       'message': message,
+                                       'encoding': 'base64' })
+            await asyncio.sleep(1.0 / write_rate)
+
+
+class EV3Client(ScratchClient):
+    def on_data(self, data, now):
+        if not self.results.recording:
+            return
+        # One message may carry several frames with --batch-frames
+        offset = 0
+        while offset + EV3_FRAME.size <= len(data):
+            length, counter, kind, sent = EV3_FRAME.unpack_from(data, offset)
+            self.results.notify_latency.append(now - sent)
+            offset += 2 + length
+
+    async def session(self, device, write_rate, stop):
+        start = time.perf_counter()
+        await self.call('discover', { 'majorDeviceClass': 8,
+                                      'minorDeviceClass': 1 })
+        peripheral_id = await self.find(device.name, start)
+        await self.call('connect', { 'peripheralId': peripheral_id,
+                                     'pin': "1234" })
+        self.results.connected += 1
+        # Direct command without reply: play a tone
+        command = bytes.fromhex("0f0000008000009401810282e80382e803")
+        message = base64.standard_b64encode(command).decode('ascii')
+        while not stop.is_set():
+            await self.call('send', { 'message': message,
+                                      'encoding': 'base64' })
+            await asyncio.sleep(1.0 / write_rate)
+
+
+async def client(url, client_class, device, args, results, stop):
+    try:
+        async with websockets.connect(url, max_queue=None) as ws:
+            c = client_class(ws, results)
+            reader = asyncio.create_task(c.read())
+            try:
+                await c.session(device, args.write_rate, stop)
+            finally:
+                reader.cancel()
+    except Exception as e:
+        results.errors += 1
+        print(f"client for {device.addr} failed: {e}", file=sys.stderr)
+
+
+def memory():
+    """Return (current, peak) resident memory in MB"""
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                values[key] = int(value.split()[0]) / 1024
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+
+def server_threads():
+    return sum(1 for t in threading.enumerate() if t.name != "fake-devices")
+
+
+async def sample_threads(peak):
+    while True:
+        peak[0] = max(peak[0], server_threads())
+        await asyncio.sleep(0.1)
+
+
+def make_devices(args):
+    """Create the simulated devices, return (micro:bits, EV3s)"""
+    FakeScanner.interval = args.scan_interval
+    FakeDeviceDiscoverer.inquiry_time = args.inquiry_time
+    FakeDeviceDiscoverer.name_lookup_time = args.name_lookup_time
+    FakePeripheral.adapter_capacity = args.adapter_capacity
+    microbits = [FakeMicrobit(f"f0:00:00:00:{i // 256:02x}:{i % 256:02x}",
+                              f"BBC micro:bit [{i:05d}]", args.rate)
+                 for i in range(args.ble_clients)]
+    ev3s = [FakeEV3(f"00:16:53:00:{i // 256:02x}:{i % 256:02x}",
+                    f"EV3-{i}", args.bt_rate)
+            for i in range(args.bt_clients)]
+    return microbits, ev3s
+
+
+def fake_worker(bench_args, sock, args, adapters=None):
+    """Run a scratch_link worker process with its own simulated devices"""
+    scratch_link.logger.setLevel(logging.WARNING)
+    make_devices(bench_args)
+    scratch_link.worker_main(sock, args, adapters)
+
+
+async def run(args, server_args):
+    scratch_link.logger.setLevel(logging.WARNING)
+    scratch_link.configure(server_args)
+    workers = scratch_link.Session.workers
+    if workers:
+        # Devices are reached from the worker processes
+        workers.target = functools.partial(fake_worker, args)
+        await workers.start()
+    microbits, ev3s = make_devices(args)
+
+    results = Results()
+    stop = asyncio.Event()
+    peak_threads = [server_threads()]
+    sampler = asyncio.create_task(sample_threads(peak_threads))
+    async with websockets.serve(scratch_link.ws_handler, "127.0.0.1", 0,
+                                max_queue=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        url = f"ws://127.0.0.1:{port}/scratch"
+        tasks = [asyncio.create_task(client(url + "/ble", MicrobitClient,
+                                            device, args, results, stop))
+                 for device in microbits]
+        tasks += [asyncio.create_task(client(url + "/bt", EV3Client,
+                                             device, args, results, stop))
+                  for device in ev3s]
+        # Let every client connect before recording
+        deadline = time.monotonic() + args.connect_timeout
+        while (results.connected + results.errors < len(tasks) and
+               time.monotonic() < deadline):
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(args.warmup)
+        results.recording = True
+        start = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        results.recording = False
+        elapsed = time.perf_counter() - start
+        rss, peak_rss = memory()
+        adapters = scratch_link.BLESession.adapters
+        adapter_stats = adapters.stats() if adapters else {}
+        stop.set()
+        await asyncio.gather(*tasks)
+    sampler.cancel()
+
+    report = {
+        'clients': len(tasks),
+        'connected': results.connected,
+        'errors': results.errors,
+        'notifications_per_s': len(results.notify_latency) / elapsed,
+        'notify_p50_ms': percentile(results.notify_latency, 50) * 1000,
+        'notify_p99_ms': percentile(results.notify_latency, 99) * 1000,
+        'requests_per_s': len(results.request_latency) / elapsed,
+        'request_p50_ms': percentile(results.request_latency, 50) * 1000,
+        'request_p99_ms': percentile(results.request_latency, 99) * 1000,
+        'discover_p50_ms': percentile(results.discover_time, 50) * 1000,
+        'discover_max_ms': max(results.discover_time, default=0) * 1000,
+        'threads': peak_threads[0],
+        'rss_mb': peak_rss,
+        'adapters': adapter_stats,
+    }
+    # Give closed sessions a moment to release their devices
+    await asyncio.sleep(1.5)
+    report['threads_left'] = server_threads() - 1
+    if workers:
+        workers.close()
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Return the metrics that got worse than the baseline by tolerance"""
+    regressions = []
+    for key, base in baseline.items():
+        value = report.get(key)
+        if not isinstance(base, (int, float)) or value is None or base == 0:
+            continue
+        if key in LOWER_IS_BETTER:
+            worse = value > base * (1 + tolerance)
+        elif key.endswith('_per_s'):
+            worse = value < base * (1 - tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append(f"{key}: {value:.2f} (baseline {base:.2f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ble-clients", type=int, default=20)
+    parser.add_argument("--bt-clients", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=50,
+                        help="micro:bit notifications per second (default: 50)")
+    parser.add_argument("--bt-rate", type=float, default=20,
+                        help="EV3 frames per second (default: 20)")
+    parser.add_argument("--write-rate", type=float, default=10,
+                        help="requests per second per client (default: 10)")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--connect-timeout", type=float, default=30)
+    parser.add_argument("--scan-interval", type=float, default=0.1,
+                        help="seconds between advertisements (default: 0.1)")
+    parser.add_argument("--inquiry-time", type=float, default=0.5,
+                        help="seconds a BT inquiry takes (default: 0.5)")
+    parser.add_argument("--name-lookup-time", type=float, default=1.0,
+                        help="seconds a BT name lookup takes (default: 1)")
+    parser.add_argument("--adapter-capacity", type=int, default=0,
+                        help="BLE connections a simulated adapter accepts "
+                        "(default: 0, no limit)")
+    parser.add_argument("--save", metavar="FILE",
+                        help="write the report to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="fail when worse than the report in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression (default: 0.2)")
+    args, rest = parser.parse_known_args()
+    server_args = scratch_link.parse_args(rest)
+
+    report = asyncio.run(run(args, server_args))
+    print(f"ble_clients={args.ble_clients} bt_clients={args.bt_clients} "
+          f"rate={args.rate}/s bt_rate={args.bt_rate}/s "
+          f"write_rate={args.write_rate}/s duration={args.duration}s "
+          f"io_backend={server_args.io_backend} "
+          f"workers={server_args.workers}")
+    print(f"  connected          {report['connected']:8d} / {report['clients']}")
+    print(f"  notifications/s    {report['notifications_per_s']:8.0f}")
+    print(f"  notify p50         {report['notify_p50_ms']:8.2f} ms")
+    print(f"  notify p99         {report['notify_p99_ms']:8.2f} ms")
+    print(f"  requests/s         {report['requests_per_s']:8.0f}")
+    print(f"  request p50        {report['request_p50_ms']:8.2f} ms")
+    print(f"  request p99        {report['request_p99_ms']:8.2f} ms")
+    print(f"  discover p50       {report['discover_p50_ms']:8.2f} ms")
+    print(f"  discover max       {report['discover_max_ms']:8.2f} ms")
+    print(f"  threads (peak)     {report['threads']:8d}")
+    print(f"  threads left       {report['threads_left']:8d}")
+    print(f"  rss (peak)         {report['rss_mb']:8.1f} MB")
+    for adapter, stats in report['adapters'].items():
+        print(f"  {adapter} connections   {stats['connections']:8d}"
+              f"{'  scanning' if stats['scanning'] else ''}")
+
+    status = 0
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        status = 1 if regressions else 0
+    sys.stdout.flush()
+    # Device threads of closed sessions may still be running
+    os._exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Measure event loop stalls caused by blocking request handlers.
+
+N sessions each send requests whose handler blocks for a while, the way
+a BLE scan or an RFCOMM connect does. Run once with request handling on
+the event loop (--request-workers 0, the old behaviour) and once with
+the executor to compare stall time.
+"""
+
+import argparse
+import asyncio
+import time
+
+from fakes import FakeWebSocket
+import scratch_link
+
+
+class BlockingSession(scratch_link.Session):
+    block = 0.2
+
+    def handle_request(self, method, params):
+        time.sleep(self.block)
+        return { "jsonrpc": "2.0", "result": None }
+
+
+async def run(args):
+    scratch_link.Session.dispatcher = None
+    if args.request_workers > 0:
+        scratch_link.Session.dispatcher = scratch_link.RequestDispatcher(
+            args.request_workers)
+    BlockingSession.block = args.block
+    monitor = scratch_link.LoopMonitor(interval=0.01, threshold=0.05)
+    monitor_task = asyncio.create_task(monitor.run())
+
+    loop = asyncio.get_running_loop()
+    sockets = [FakeWebSocket() for i in range(args.sessions)]
+    for ws in sockets:
+        for i in range(args.requests):
+            ws.add_request('discover', {}, id=i)
+        ws.close_connection()
+    sessions = [BlockingSession(ws, loop) for ws in sockets]
+    start = time.perf_counter()
+    await asyncio.gather(*[s.handle() for s in sessions],
+                         return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    monitor_task.cancel()
+    if scratch_link.Session.dispatcher:
+        scratch_link.Session.dispatcher.shutdown()
+
+    report = monitor.report()
+    print(f"request_workers={args.request_workers} sessions={args.sessions} "
+          f"requests={args.requests} block={args.block}s")
+    print(f"  elapsed     {elapsed:8.3f} s")
+    print(f"  max stall   {report['max_stall'] * 1000:8.1f} ms")
+    print(f"  total stall {report['total_stall'] * 1000:8.1f} ms")
+    print(f"  stalls      {report['stalls']:8d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--request-workers", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--block", type=float, default=0.2)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Measure BLE notification throughput on one core.
+
+A thread feeds notifications into BLEDelegate.handleNotification as fast
+as possible while the session's writer task sends them to a fake
+websocket. Report notifications per second of wall time and per second
+of CPU time, with the JSON library chosen by --json.
+
+With --duplicates 0.8, eight in ten notifications repeat the previous
+payload, like an idle sensor. Compare the messages sent with the
+default policy, which sends them, and with --notify-policy
+'*=0,skip-duplicates'. A rate limit such as --notify-policy '*=50' holds
+notifications back on the event loop and the last one is sent at the
+end of the interval.
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import struct
+import threading
+import time
+
+from fakes import FakeWebSocket
+import scratch_link
+
+HANDLE = 0x25
+
+
+def payloads(count, duplicates):
+    """Return count 20 byte payloads, repeating the previous one at random"""
+    rng = random.Random(1)
+    data = []
+    value = 0
+    for i in range(count):
+        if not data or rng.random() >= duplicates:
+            value += 1
+        data.append(struct.pack("<I16x", value))
+    return data
+
+
+def feed(delegate, data):
+    for payload in data:
+        delegate.handleNotification(HANDLE, payload)
+
+
+async def run(args):
+    scratch_link.logger.setLevel(logging.INFO)
+    scratch_link.codec.use(args.json == 'orjson')
+    scratch_link.Session.send_queue_policy = scratch_link.SendQueue.BLOCK
+    if args.notify_policy:
+        scratch_link.BLESession.notification_policies = dict(args.notify_policy)
+    loop = asyncio.get_running_loop()
+    ws = FakeWebSocket()
+    session = scratch_link.BLESession(ws, loop)
+    session.status = session.CONNECTED
+    session.delegate = session.BLEDelegate(session)
+    session.delegate.add_handle(0xf005, "5261da01-fa7e-42ab-850b-7c80220097cc",
+                                HANDLE)
+    writer = asyncio.create_task(session.send_queue.drain(ws))
+    data = payloads(args.count, args.duplicates)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    feeder = threading.Thread(target=feed, args=(session.delegate, data))
+    feeder.start()
+    while feeder.is_alive() or len(session.send_queue):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    feeder.join()
+    # Let a held back last value go out
+    await asyncio.sleep(0.1)
+    writer.cancel()
+
+    stats = session.stats().get('notifications', {})
+    print(f"json={scratch_link.codec.name} notifications={args.count} "
+          f"duplicates={args.duplicates}")
+    print(f"  wall   {args.count / elapsed:10.0f} notifications/s")
+    print(f"  cpu    {args.count / cpu:10.0f} notifications/cpu-s")
+    print(f"  sent   {len(ws.sent):10d} messages")
+    for chara_id, counts in stats.items():
+        print(f"  {chara_id}: {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", choices=('orjson', 'json'), default='orjson')
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--duplicates", type=float, default=0,
+                        help="fraction of notifications repeating the "
+                        "previous payload (default: 0)")
+    parser.add_argument("--notify-policy", action="append", default=[],
+                        type=scratch_link.NotificationPolicy.parse,
+                        metavar="UUID=RATE[,skip-duplicates]")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Measure the startup cost of scratch_link.
+
+Each run starts a fresh interpreter, imports scratch_link, configures it
+from the default command line and loads the BLE and BT backends as the
+first session on their path would. Report the median time of each step,
+the modules the import pulled in and whether it loaded a Bluetooth stack,
+which it should leave to the first session that needs it.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CHILD = r"""
+import json, sys, time
+start = time.perf_counter()
+before = set(sys.modules)
+import scratch_link
+imported = time.perf_counter()
+modules = len(set(sys.modules) - before)
+stacks = [name for name in ('bluepy.btle', 'bluetooth') if name in sys.modules]
+scratch_link.configure(scratch_link.parse_args([]))
+configured = time.perf_counter()
+loads = {}
+for path in ('/scratch/ble', '/scratch/bt'):
+    t = time.perf_counter()
+    try:
+        scratch_link.backends.session_type(path)
+        loads[path] = (time.perf_counter() - t) * 1000
+    except ImportError as e:
+        loads[path] = None
+print(json.dumps({ 'import_ms': (imported - start) * 1000,
+                   'configure_ms': (configured - imported) * 1000,
+                   'modules': modules, 'stacks_at_import': stacks,
+                   'backend_ms': loads }))
+"""
+
+
+def run_once():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", CHILD], env=env, check=True,
+                         capture_output=True, text=True).stdout
+    report = json.loads(out.splitlines()[-1])
+    report['process_ms'] = (time.perf_counter() - start) * 1000
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    reports = [run_once() for i in range(args.runs)]
+    def median(values):
+        values = [v for v in values if v is not None]
+        return statistics.median(values) if values else float('nan')
+    print(f"runs={args.runs}")
+    print(f"  process            {median(r['process_ms'] for r in reports):8.1f} ms")
+    print(f"  import             {median(r['import_ms'] for r in reports):8.1f} ms"
+          f"  ({reports[-1]['modules']} modules)")
+    print(f"  configure          {median(r['configure_ms'] for r in reports):8.1f} ms")
+    for path in ('/scratch/ble', '/scratch/bt'):
+        print(f"  load {path:13s} "
+              f"{median(r['backend_ms'][path] for r in reports):8.1f} ms")
+    stacks = reports[-1]['stacks_at_import']
+    print(f"  stacks at import   {', '.join(stacks) if stacks else 'none'}")
+
+
+if __name__ == "__main__":
+    main()
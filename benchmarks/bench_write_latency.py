@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Measure BLE write latency while notifications are flowing.
+
+One connected BLE session receives notifications from a fake peripheral
+while Scratch-like write requests are sent at a fixed rate. Report the
+write latency and the time writes waited for the peripheral. With
+--write-delay above the write interval, the device cannot keep up;
+compare with and without --coalesce-writes.
+"""
+
+import argparse
+import asyncio
+import base64
+import logging
+import threading
+import time
+
+from bluepy.btle import Characteristic
+
+from fakes import FakeWebSocket, FakePeripheral, FakeBLEDevice
+import scratch_link
+
+SERVICE = "e95d0753-251d-470a-a062-fa1922dfa9a8"
+NOTIFY_CHARA = "e95dca4b-251d-470a-a062-fa1922dfa9a8"
+WRITE_CHARA = "e95d93ee-251d-470a-a062-fa1922dfa9a8"
+NOTIFY_HANDLE = 0x25
+WRITE_HANDLE = 0x30
+
+
+def connect(session, perip):
+    """Put the session in the state a connect request leaves it in"""
+    session.perip = perip
+    session.delegate = session.BLEDelegate(session)
+    perip.withDelegate(session.delegate)
+    session.delegate.add_handle(SERVICE, NOTIFY_CHARA, NOTIFY_HANDLE)
+    cache = session.gatt_cache
+    for chara, handle in ((NOTIFY_CHARA, NOTIFY_HANDLE),
+                          (WRITE_CHARA, WRITE_HANDLE)):
+        cache.entries[cache.key(perip.addr, SERVICE, chara)] = \
+            Characteristic(perip, chara, handle - 1, 0x1e, handle)
+    session.status = session.CONNECTED
+
+
+def feed(perip, rate, stop):
+    while not stop.is_set():
+        perip.push_notification(NOTIFY_HANDLE, b"\x01\x02\x03\x04\x05\x06")
+        time.sleep(1.0 / rate)
+
+
+async def run(args):
+    scratch_link.logger.setLevel(logging.WARNING)
+    scratch_link.Session.io_backend = args.io_backend
+    scratch_link.Session.dispatcher = scratch_link.RequestDispatcher(4)
+    scratch_link.BLESession.coalesce_writes = args.coalesce_writes
+    loop = asyncio.get_running_loop()
+    ws = FakeWebSocket()
+    session = scratch_link.BLESession(ws, loop)
+    perip = FakePeripheral(device=FakeBLEDevice(args.write_delay))
+    if args.io_backend == 'thread':
+        session.status = session.DISCOVERY
+        session.ble_thread = session.BLEThread(session)
+        session.ble_thread.daemon = True
+        session.ble_thread.start()
+    connect(session, perip)
+    if args.io_backend == 'thread':
+        session.ble_thread.wakeup()
+    else:
+        session.add_helper_reader()
+    task = asyncio.create_task(session.handle())
+
+    stop = threading.Event()
+    feeder = threading.Thread(target=feed, args=(perip, args.notify_rate, stop))
+    feeder.start()
+    message = base64.standard_b64encode(b"\x00\x10").decode('ascii')
+    for i in range(args.writes):
+        ws.add_request('write', { 'serviceId': SERVICE,
+                                  'characteristicId': WRITE_CHARA,
+                                  'message': message,
+                                  'encoding': 'base64' }, id=i)
+        await asyncio.sleep(1.0 / args.write_rate)
+    start = time.perf_counter()
+    while ws.responses < args.writes:
+        await asyncio.sleep(0.01)
+    drain = time.perf_counter() - start
+    stop.set()
+    feeder.join()
+
+    print(f"io_backend={args.io_backend} writes={args.writes} "
+          f"write_rate={args.write_rate}/s notify_rate={args.notify_rate}/s")
+    print(f"  write latency {session.write_latency}")
+    print(f"  lock wait     {session.lock_wait}")
+    print(f"  device writes {perip.device.writes}")
+    print(f"  drain time    {drain * 1000:.1f}ms after the last request")
+    if session.write_scheduler:
+        print(f"  scheduler     {session.write_scheduler.stats()}")
+    ws.close_connection()
+    await asyncio.gather(task, return_exceptions=True)
+    session.close()
+    scratch_link.Session.dispatcher.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--io-backend", choices=scratch_link.Session.IO_BACKENDS,
+                        default='thread')
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--write-rate", type=float, default=50)
+    parser.add_argument("--notify-rate", type=float, default=50)
+    parser.add_argument("--write-delay", type=float, default=0,
+                        help="seconds the fake device takes per write")
+    parser.add_argument("--coalesce-writes", action="store_true")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
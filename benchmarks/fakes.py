@@ -0,0 +1,633 @@
+"""Fake websocket and device objects for benchmarks"""
+
+import asyncio
+import collections
+import heapq
+import json
+import math
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import bluetooth
+from bluepy import btle
+from bluepy.btle import Peripheral, ScanEntry, UUID, DefaultDelegate
+from bluepy.btle import BTLEDisconnectError
+
+
+class FakeWebSocket():
+    """
+    In-memory stand-in for a websockets server connection. Requests put
+    with add_request() are returned by recv(); everything the session
+    sends is kept in sent and responses are counted.
+    """
+    def __init__(self, path="/scratch/ble"):
+        self.incoming = asyncio.Queue()
+        self.sent = []
+        self.responses = 0
+        self.closed = False
+
+    def add_request(self, method, params, id=None):
+        req = { 'jsonrpc': '2.0', 'method': method, 'params': params }
+        if id is not None:
+            req['id'] = id
+        self.incoming.put_nowait(json.dumps(req))
+
+    def close_connection(self):
+        self.incoming.put_nowait(None)
+
+    async def close(self, code=1000, reason=""):
+        self.close_code = code
+        self.close_connection()
+
+    async def recv(self):
+        msg = await self.incoming.get()
+        if msg is None:
+            self.closed = True
+            raise ConnectionError("fake websocket closed")
+        return msg
+
+    async def send(self, message):
+        if self.closed:
+            raise ConnectionError("fake websocket closed")
+        self.sent.append(message)
+        if '"id"' in message:
+            self.responses += 1
+
+
+class FakeHelperInput():
+    """
+    Command input of a fake bluepy-helper. Answers the commands bluepy
+    sends with the responses the real helper would print.
+    """
+    def __init__(self, helper):
+        self.helper = helper
+
+    def write(self, cmd):
+        args = cmd.split()
+        if not args:
+            return
+        device, mtu = self.helper.device, self.helper.mtu
+        if args[0] in ('wr', 'wrr'):
+            data = bytes.fromhex(args[2])
+            if args[0] == 'wr':
+                # A write command carries what fits in one packet
+                data = data[:mtu - 3]
+                device.transfer(1)
+            elif len(data) > mtu - 3:
+                # Prepare writes and the execute write
+                device.transfer(-(-len(data) // (mtu - 5)) + 1)
+            else:
+                device.transfer(1)
+            device.on_write(int(args[1], 16), data)
+            self.helper.emit("rsp=$wr")
+        elif args[0] == 'rd':
+            data = device.on_read(int(args[1], 16))
+            # A read and the read blobs for the rest
+            device.transfer(max(1, -(-len(data) // (mtu - 1))))
+            self.helper.emit(f"rsp=$rd\x1ed=b{data.hex()}")
+        elif args[0] == 'mtu':
+            self.helper.mtu = min(int(args[1], 16), device.max_mtu)
+            self.helper.emit("rsp=$stat\x1estate=$conn\x1emtu="
+                             f"h{self.helper.mtu:x}")
+        elif args[0] == 'stat':
+            self.helper.emit("rsp=$stat\x1estate=$conn")
+        elif args[0] == 'disc':
+            self.helper.emit("rsp=$stat\x1estate=$disc")
+        elif args[0] == 'svcs':
+            uuid = UUID(args[1]) if len(args) > 1 else None
+            rsp = "rsp=$find"
+            for service, start, end, charas in self.helper.device.gatt:
+                if uuid is None or UUID(service) == uuid:
+                    rsp += f"\x1ehstart=h{start:x}\x1ehend=h{end:x}\x1euuid=${service}"
+            self.helper.emit(rsp)
+        elif args[0] == 'char':
+            start, end = int(args[1], 16), int(args[2], 16)
+            uuid = UUID(args[3]) if len(args) > 3 else None
+            rsp = "rsp=$find"
+            for service, _, _, charas in self.helper.device.gatt:
+                for chara, handle, props, val_handle in charas:
+                    if (start <= handle <= end and
+                        (uuid is None or UUID(chara) == uuid)):
+                        rsp += (f"\x1ehnd=h{handle:x}\x1euuid=${chara}"
+                                f"\x1eprops=h{props:x}\x1evhnd=h{val_handle:x}")
+            self.helper.emit(rsp)
+        elif args[0] == 'quit':
+            pass
+        else:
+            self.helper.emit("rsp=$err\x1ecode=$badcmd")
+
+    def flush(self):
+        pass
+
+
+class FakeHelper():
+    """
+    Stand-in for the bluepy-helper process. bluepy reads its responses
+    from a real pipe, so the pipe can be watched with select or the event
+    loop like the real one.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.mtu = 23
+        rfd, self.wfd = os.pipe()
+        self.stdout = os.fdopen(rfd, 'r')
+        self.stdin = FakeHelperInput(self)
+        self.lock = threading.Lock()
+
+    def emit(self, line):
+        with self.lock:
+            if self.wfd is not None:
+                os.write(self.wfd, (line + "\n").encode())
+
+    def poll(self):
+        return None
+
+    def wait(self):
+        self.device.detach(self)
+        with self.lock:
+            if self.wfd is not None:
+                os.close(self.wfd)
+                self.wfd = None
+        self.stdout.close()
+
+
+class FakeTicker():
+    """
+    One thread running the periodic work of all fake devices, so that
+    simulating many devices does not add a thread per device. A callback
+    is called every interval seconds until it returns False.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.timers = []
+        self.seq = 0
+        self.thread = None
+
+    def schedule(self, callback, delay, interval=None):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.timers, (time.perf_counter() + delay,
+                                         self.seq, callback, interval))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name="fake-devices")
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.timers:
+                    self.cond.wait()
+                when, seq, callback, interval = self.timers[0]
+                delay = when - time.perf_counter()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.timers)
+            try:
+                again = callback() is not False and interval is not None
+            except Exception as e:
+                print(f"fake device failed: {e}", file=sys.stderr)
+                again = False
+            if again:
+                with self.cond:
+                    # Skip missed ticks rather than bursting to catch up
+                    when = max(when + interval, time.perf_counter())
+                    heapq.heappush(self.timers, (when, seq, callback, interval))
+
+ticker = FakeTicker()
+
+
+class FakeBLEDevice():
+    """
+    GATT server behaviour behind a FakePeripheral. services is a list of
+    (service UUID, [(characteristic UUID, properties), ...]) laid out in
+    handles like a real device: a declaration handle, a value handle and a
+    CCCD handle per characteristic. write_delay simulates the time a write
+    takes over the air. packet_time simulates the time each ATT request
+    takes, e.g. a connection interval, and max_mtu the largest ATT MTU the
+    device accepts.
+    """
+    def __init__(self, write_delay=0, services=(), packet_time=0, max_mtu=247):
+        self.values = {}
+        self.writes = 0
+        self.packets = 0
+        self.write_delay = write_delay
+        self.packet_time = packet_time
+        self.max_mtu = max_mtu
+        self.helper = None
+        # value handle -> notifications enabled
+        self.subscribed = {}
+        # [(service UUID, start, end, [(chara UUID, handle, props, value handle)])]
+        self.gatt = []
+        self.handles = {}
+        handle = 1
+        for service, charas in services:
+            start = handle
+            layout = []
+            for chara, props in charas:
+                layout.append((str(UUID(chara)), handle + 1, props, handle + 2))
+                self.handles[UUID(chara)] = handle + 2
+                handle += 3
+            self.gatt.append((str(UUID(service)), start, handle, layout))
+            handle += 1
+
+    def attach(self, helper):
+        self.helper = helper
+
+    def detach(self, helper):
+        if self.helper is helper:
+            self.helper = None
+            self.subscribed.clear()
+
+    def transfer(self, packets):
+        self.packets += packets
+        if self.packet_time:
+            time.sleep(self.packet_time * packets)
+
+    def on_write(self, handle, data):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        self.writes += 1
+        self.values[handle] = data
+        if handle - 1 in self.handles.values():
+            self.subscribed[handle - 1] = bool(data[0] & 0x03)
+
+    def on_read(self, handle):
+        return self.values.get(handle, b"")
+
+
+class FakeMicrobit(FakeBLEDevice):
+    """
+    BBC micro:bit running the Scratch firmware. While Scratch subscribes
+    to the RX characteristic, it notifies its accelerometer tilt and
+    button state rate times per second. The perf_counter() time of the
+    notification is appended to the 10 byte state so that the receiver
+    can measure latency.
+    """
+    SERVICE = "0000f005-0000-1000-8000-00805f9b34fb"
+    RX_CHARA = "5261da01-fa7e-42ab-850b-7c80220097cc"
+    TX_CHARA = "5261da02-fa7e-42ab-850b-7c80220097cc"
+
+    def __init__(self, addr, name="BBC micro:bit", rate=50, write_delay=0,
+                 rssi=-60):
+        super().__init__(write_delay, [(self.SERVICE, [(self.RX_CHARA, 0x12),
+                                                        (self.TX_CHARA, 0x0c)])])
+        self.addr = addr
+        self.rate = rate
+        self.advertiser = FakeAdvertiser(addr, name, [self.SERVICE], rssi)
+        self.rx_handle = self.handles[UUID(self.RX_CHARA)]
+        self.notifications = 0
+        self.phase = 0
+        self.streaming = False
+        FakePeripheral.devices[addr] = self
+        FakeScanner.advertisers.append(self.advertiser)
+
+    def state(self):
+        self.phase += 1
+        angle = self.phase * 2 * math.pi / max(1, self.rate)
+        tilt_x = int(1024 * math.sin(angle))
+        tilt_y = int(1024 * math.cos(angle))
+        buttons = (self.phase // max(1, self.rate)) % 2
+        return struct.pack(">hhBBBBBB", tilt_x, tilt_y, buttons, 0, 0, 0, 0, 0)
+
+    def on_read(self, handle):
+        if handle == self.rx_handle:
+            return self.state()
+        return super().on_read(handle)
+
+    def on_write(self, handle, data):
+        super().on_write(handle, data)
+        if self.subscribed.get(self.rx_handle) and not self.streaming:
+            self.streaming = True
+            ticker.schedule(self.tick, 0, 1.0 / self.rate)
+
+    def tick(self):
+        helper = self.helper
+        if helper is None or not self.subscribed.get(self.rx_handle):
+            self.streaming = False
+            return False
+        data = self.state() + struct.pack("<d", time.perf_counter())
+        helper.emit(f"rsp=$ntfy\x1ehnd=h{self.rx_handle:x}\x1ed=b{data.hex()}")
+        self.notifications += 1
+
+
+class FakePeripheral(Peripheral):
+    """
+    A connected bluepy Peripheral talking to a FakeHelper. Without a
+    device, the device registered in devices for the address is used.
+    Each iface simulates an adapter accepting adapter_capacity
+    connections, like the controller of a real adapter.
+    """
+    # address -> FakeBLEDevice
+    devices = {}
+    # 0 for no limit
+    adapter_capacity = 0
+    adapter_connections = collections.Counter()
+    adapter_lock = threading.Lock()
+
+    def __init__(self, addr="f0:00:00:00:00:01", addrType="random",
+                 iface=None, device=None):
+        with self.adapter_lock:
+            if (self.adapter_capacity and
+                self.adapter_connections[iface] >= self.adapter_capacity):
+                raise BTLEDisconnectError(
+                    f"fake adapter hci{iface} has no room for {addr}")
+            self.adapter_connections[iface] += 1
+        Peripheral.__init__(self)
+        self.addr = addr
+        self.addrType = addrType
+        self.iface = iface
+        self.device = device or self.devices.get(addr) or FakeBLEDevice()
+        self._helper = FakeHelper(self.device)
+        self.device.attach(self._helper)
+        self._poller = select.poll()
+        self._poller.register(self._helper.stdout, select.POLLIN)
+
+    def disconnect(self):
+        if self._helper is not None:
+            with self.adapter_lock:
+                self.adapter_connections[self.iface] -= 1
+        Peripheral.disconnect(self)
+
+    def push_notification(self, handle, data):
+        """Make the device send a notification"""
+        helper = self._helper
+        if helper is not None:
+            helper.emit(f"rsp=$ntfy\x1ehnd=h{handle:x}\x1ed=b{data.hex()}")
+
+
+class FakeAdvertiser():
+    """A BLE device advertising its name and 16-bit/128-bit services"""
+    def __init__(self, addr, name, services=(), rssi=-60, manufacturer=None):
+        self.addr = addr
+        self.name = name
+        self.services = services
+        self.rssi = rssi
+        self.manufacturer = manufacturer
+
+    def advertising_data(self):
+        data = bytearray()
+        def field(ad_type, value):
+            data.extend(bytes([len(value) + 1, ad_type]))
+            data.extend(value)
+        field(ScanEntry.COMPLETE_LOCAL_NAME, self.name.encode())
+        for service in self.services:
+            uuid = UUID(service)
+            if str(uuid).endswith("-0000-1000-8000-00805f9b34fb"):
+                field(ScanEntry.COMPLETE_16B_SERVICES, uuid.binVal[2:4][::-1])
+            else:
+                field(ScanEntry.COMPLETE_128B_SERVICES, uuid.binVal[::-1])
+        if self.manufacturer is not None:
+            field(ScanEntry.MANUFACTURER, self.manufacturer)
+        return bytes(data)
+
+    def scan_entry(self, iface=0):
+        entry = ScanEntry(self.addr, iface)
+        entry._update({ 'type': [2], 'rssi': [-self.rssi], 'flag': [0],
+                        'd': [self.advertising_data()] })
+        return entry
+
+
+class FakeScanner():
+    """
+    Stand-in for bluepy's Scanner. Every advertiser in advertisers is
+    reported once per interval while the scan runs.
+    """
+    advertisers = []
+    interval = 0.1
+
+    def __init__(self, iface=0):
+        self.iface = iface
+        self.delegate = DefaultDelegate()
+        self.entries = {}
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def start(self, passive=False):
+        pass
+
+    def stop(self):
+        pass
+
+    def clear(self):
+        self.entries = {}
+
+    def process(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for adv in list(self.advertisers):
+                entry = self.entries.get(adv.addr)
+                is_new = entry is None
+                if is_new:
+                    entry = self.entries[adv.addr] = adv.scan_entry(self.iface)
+                entry.rssi = adv.rssi
+                self.delegate.handleDiscovery(entry, is_new, False)
+            time.sleep(min(self.interval, max(0, deadline - time.monotonic())))
+
+    def scan(self, timeout=10, passive=False):
+        self.process(timeout)
+        return list(self.entries.values())
+
+
+class FakeEV3():
+    """
+    LEGO EV3 brick reachable over RFCOMM. While connected, it sends
+    length-prefixed reply frames rate times per second: a little-endian
+    16-bit length, a 16-bit message counter, the direct reply type and
+    the perf_counter() time of the frame, so that the receiver can
+    measure latency. Commands from Scratch are counted.
+    """
+    DEVICE_CLASS = 0x0804  # major class toy, minor class robot
+    DIRECT_REPLY = 0x02
+
+    def __init__(self, addr, name="EV3", rate=20, rssi=-50):
+        self.addr = addr
+        self.name = name
+        self.rate = rate
+        self.rssi = rssi
+        self.peer = None
+        self.frames = 0
+        self.overruns = 0
+        self.received = 0
+        FakeDeviceDiscoverer.devices.append(self)
+
+    def frame(self):
+        payload = struct.pack("<HBd", self.frames & 0xFFFF, self.DIRECT_REPLY,
+                              time.perf_counter())
+        return struct.pack("<H", len(payload)) + payload
+
+    def attach(self, peer):
+        peer.setblocking(False)
+        self.peer = peer
+        ticker.schedule(lambda: self.tick(peer), 0, 1.0 / self.rate)
+
+    def detach(self, peer):
+        if self.peer is peer:
+            self.peer = None
+        peer.close()
+
+    def tick(self, peer):
+        if self.peer is not peer:
+            return False
+        try:
+            while True:
+                data = peer.recv(4096)
+                if not data:
+                    return False
+                self.received += len(data)
+        except BlockingIOError:
+            pass
+        except OSError:
+            return False
+        try:
+            peer.send(self.frame())
+            self.frames += 1
+        except BlockingIOError:
+            # Scratch link does not read fast enough
+            self.overruns += 1
+        except OSError:
+            return False
+
+
+class FakeBluetoothSocket():
+    """
+    Stand-in for bluetooth.BluetoothSocket. connect() attaches the other
+    end of a socketpair to the FakeEV3 registered for the address.
+    """
+    def __init__(self, proto=None):
+        self.sock, self.peer = socket.socketpair()
+        self.device = None
+
+    def connect(self, addrport):
+        addr = addrport[0]
+        for device in FakeDeviceDiscoverer.devices:
+            if device.addr == addr:
+                self.device = device
+                device.attach(self.peer)
+                return
+        raise bluetooth.BluetoothError(f"no fake device at {addr}")
+
+    def close(self):
+        if self.device:
+            self.device.detach(self.peer)
+        else:
+            self.peer.close()
+        self.sock.close()
+
+    def send(self, data, flags=0):
+        # Like pybluez, which parses data with "s#" and turns every socket
+        # error, EAGAIN too, into a BluetoothError
+        if not isinstance(data, (bytes, str)):
+            raise TypeError(f"a bytes-like object is required, not "
+                            f"'{type(data).__name__}'")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        try:
+            return self.sock.send(data, flags)
+        except OSError as e:
+            raise bluetooth.BluetoothError(e.errno, e.strerror)
+
+    def __getattr__(self, name):
+        # fileno, recv, recv_into, setblocking...
+        return getattr(self.sock, name)
+
+
+class FakeDeviceDiscoverer():
+    """
+    Stand-in for bluetooth.DeviceDiscoverer. An inquiry reports every
+    device in devices, then completes after inquiry_time seconds. Events
+    are signalled on a pipe so the discoverer can be selected on like the
+    real one.
+    """
+    devices = []
+    inquiry_time = 0.5
+    name_lookup_time = 1.0
+
+    def __init__(self, device_id=-1):
+        self.rfd, self.wfd = os.pipe()
+        self.events = collections.deque()
+        self.lock = threading.Lock()
+        self.inquiring = False
+
+    def find_devices(self, lookup_names=True, duration=8, flush_cache=True):
+        self.pre_inquiry()
+        self.inquiring = True
+        for device in self.devices:
+            name = device.name.encode() if lookup_names else None
+            self.post(self.device_discovered, device.addr,
+                      device.DEVICE_CLASS, device.rssi, name)
+        ticker.schedule(lambda: self.post(self.complete), self.inquiry_time)
+
+    def post(self, callback, *args):
+        with self.lock:
+            if self.wfd is None:
+                return
+            self.events.append((callback, args))
+            os.write(self.wfd, b"e")
+
+    def complete(self):
+        if self.inquiring:
+            self.inquiring = False
+            self.inquiry_complete()
+
+    def process_event(self):
+        os.read(self.rfd, 1)
+        callback, args = self.events.popleft()
+        callback(*args)
+
+    def cancel_inquiry(self):
+        self.inquiring = False
+
+    def fileno(self):
+        return self.rfd
+
+    def pre_inquiry(self):
+        pass
+
+    def device_discovered(self, address, device_class, rssi, name):
+        pass
+
+    def inquiry_complete(self):
+        pass
+
+    def __del__(self):
+        with self.lock:
+            os.close(self.rfd)
+            os.close(self.wfd)
+            self.wfd = None
+
+
+def lookup_name(address, timeout=10):
+    """
+    Stand-in for bluetooth.lookup_name, taking name_lookup_time seconds
+    like a remote name request
+    """
+    time.sleep(FakeDeviceDiscoverer.name_lookup_time)
+    for device in FakeDeviceDiscoverer.devices:
+        if device.addr == address:
+            return device.name
+    return None
+
+
+def install():
+    """
+    Replace the bluepy and pybluez classes scratch_link uses with the
+    fakes. Call this before scratch_link starts its first BT inquiry,
+    which subclasses bluetooth.DeviceDiscoverer.
+    """
+    btle.Scanner = FakeScanner
+    btle.Peripheral = FakePeripheral
+    bluetooth.BluetoothSocket = FakeBluetoothSocket
+    bluetooth.DeviceDiscoverer = FakeDeviceDiscoverer
+    bluetooth.lookup_name = lookup_name
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+Replay a trace recorded with scratch_link --record.
+
+Every recorded session becomes a Scratch-like websocket client sending
+the recorded requests to ws_handler, and a simulated device reproducing
+the recorded device side: a BLE device notifying the recorded values and
+answering reads with the recorded ones, or an EV3 sending the recorded
+RFCOMM frames. Device traffic keeps its timing relative to the request
+which started it, and sessions start at their recorded offsets.
+
+--speed 1 replays in real time, --speed 2 twice as fast and --speed 0 as
+fast as possible. Report request latency, throughput and how much
+longer than the recording the replay took. Options not listed here are
+passed to scratch_link, so a trace from a lagging classroom can be
+replayed against a change. --save and --baseline work as in bench_load.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import sys
+import time
+
+import websockets
+
+from bench_load import ScratchClient, Results, compare, percentile
+from fakes import FakeBLEDevice, FakeAdvertiser, FakeEV3
+from fakes import FakePeripheral, FakeScanner, UUID, ticker
+import scratch_link
+
+TraceRecorder = scratch_link.TraceRecorder
+
+# read, write without response, write, notify
+CHARA_PROPS = 0x1e
+
+
+class SessionPlan():
+    """What one recorded session did, with times relative to its start"""
+    def __init__(self, session_id, path, start):
+        self.session_id = session_id
+        self.path = path
+        self.start = start
+        self.end = 0
+        # [(time, request dict)]
+        self.requests = []
+        # [(time, notification dict)] sent to Scratch
+        self.notifications = []
+        # [(time, characteristic ID, data)] or [(time, None, frame)] for BT
+        self.device_data = []
+        # characteristic ID -> [values read]
+        self.reads = collections.defaultdict(collections.deque)
+
+    def add(self, t, event, payload):
+        self.end = t
+        if event == TraceRecorder.REQUEST:
+            self.requests.append((t, json.loads(payload)))
+        elif event == TraceRecorder.NOTIFY:
+            self.notifications.append((t, json.loads(payload)))
+        elif event == TraceRecorder.BLE_NOTIFY:
+            chara_id, data = TraceRecorder.split_chara_payload(payload)
+            self.device_data.append((t, chara_id, data))
+        elif event == TraceRecorder.BLE_READ:
+            chara_id, data = TraceRecorder.split_chara_payload(payload)
+            self.reads[chara_id].append(data)
+        elif event == TraceRecorder.BT_RECV:
+            self.device_data.append((t, None, payload))
+
+    def request(self, method):
+        for t, req in self.requests:
+            if req['method'] == method:
+                return t, req
+        return None, None
+
+    def device_name(self):
+        """Return the name the connected device was discovered with"""
+        t, connect = self.request('connect')
+        if connect is None:
+            return None
+        peripheral_id = connect['params']['peripheralId']
+        for t, msg in self.notifications:
+            params = msg.get('params', {})
+            if (msg.get('method') == 'didDiscoverPeripheral' and
+                params.get('peripheralId') == peripheral_id):
+                return params.get('name')
+        return str(peripheral_id)
+
+    def anchor(self):
+        """Time of the request that starts the device traffic"""
+        if self.path == '/scratch/bt':
+            return self.request('connect')[0]
+        for t, req in self.requests:
+            if (req['method'] == 'read' and
+                req.get('params', {}).get('startNotifications')):
+                return t
+        return None
+
+    def notified(self):
+        return sum(1 for t, msg in self.notifications
+                   if msg.get('method') in ('characteristicDidChange',
+                                            'didReceiveMessage'))
+
+
+def load_plans(path):
+    plans = {}
+    first = None
+    for t, event, session_id, payload in TraceRecorder.read(path):
+        if first is None:
+            first = t
+        if event == TraceRecorder.OPEN:
+            plans[session_id] = SessionPlan(session_id, payload.decode(),
+                                            t - first)
+        elif session_id in plans:
+            plan = plans[session_id]
+            plan.add(t - first - plan.start, event, payload)
+    return list(plans.values())
+
+
+class ReplayBLEDevice(FakeBLEDevice):
+    """
+    BLE device of a recorded session. When Scratch subscribes, it notifies
+    the recorded values at their recorded times after the subscription.
+    Reads return the recorded values in turn.
+    """
+    def __init__(self, plan, addr, name, speed):
+        charas = collections.defaultdict(set)
+        for t, req in plan.requests:
+            params = req.get('params', {})
+            if 'characteristicId' in params:
+                charas[params['serviceId']].add(params['characteristicId'])
+        super().__init__(0, [(service, [(chara, CHARA_PROPS)
+                                        for chara in sorted(ids)])
+                             for service, ids in charas.items()])
+        self.plan = plan
+        self.speed = speed
+        self.chara_ids = { handle: str(uuid)
+                           for uuid, handle in self.handles.items() }
+        self.last_read = {}
+        self.streaming = False
+        services = []
+        t, discover = plan.request('discover')
+        for device_filter in (discover or {}).get('params', {}).get('filters', []):
+            services += device_filter.get('services', [])
+        self.advertiser = FakeAdvertiser(addr, name, services)
+        FakePeripheral.devices[addr] = self
+        FakeScanner.advertisers.append(self.advertiser)
+
+    def on_read(self, handle):
+        chara_id = self.chara_ids.get(handle)
+        values = self.plan.reads.get(chara_id)
+        if values:
+            self.last_read[chara_id] = values.popleft()
+        return self.last_read.get(chara_id, b"")
+
+    def on_write(self, handle, data):
+        super().on_write(handle, data)
+        if any(self.subscribed.values()) and not self.streaming:
+            self.streaming = True
+            anchor = self.plan.anchor() or 0
+            for t, chara_id, value in self.plan.device_data:
+                delay = (t - anchor) / self.speed if self.speed else 0
+                ticker.schedule(lambda c=chara_id, v=value: self.notify(c, v),
+                                max(0, delay))
+
+    def notify(self, chara_id, value):
+        helper = self.helper
+        handle = self.handles.get(UUID(chara_id))
+        if helper is None or handle is None:
+            return
+        helper.emit(f"rsp=$ntfy\x1ehnd=h{handle:x}\x1ed=b{value.hex()}")
+
+
+class ReplayEV3(FakeEV3):
+    """EV3 of a recorded session sending the recorded RFCOMM frames"""
+    def __init__(self, plan, addr, name, speed):
+        t, discover = plan.request('discover')
+        params = (discover or {}).get('params', {})
+        self.DEVICE_CLASS = ((params.get('majorDeviceClass', 8) << 8) |
+                             (params.get('minorDeviceClass', 1) << 2))
+        super().__init__(addr, name)
+        self.plan = plan
+        self.speed = speed
+
+    def attach(self, peer):
+        peer.setblocking(False)
+        self.peer = peer
+        anchor = self.plan.anchor() or 0
+        for t, chara_id, frame in self.plan.device_data:
+            delay = (t - anchor) / self.speed if self.speed else 0
+            ticker.schedule(lambda f=frame: self.send_frame(peer, f),
+                            max(0, delay))
+
+    def send_frame(self, peer, frame):
+        if self.peer is not peer:
+            return
+        try:
+            while peer.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        try:
+            peer.send(frame)
+            self.frames += 1
+        except BlockingIOError:
+            self.overruns += 1
+        except OSError:
+            pass
+
+
+class ReplayClient(ScratchClient):
+    def on_data(self, data, now):
+        self.results.notified += 1
+
+
+def make_device(plan, speed):
+    """Create the simulated device of a session, return its name"""
+    name = plan.device_name()
+    if name is None:
+        return None
+    name = f"{name} #{plan.session_id}"
+    addr = (f"f1:00:00:{plan.session_id >> 16 & 0xff:02x}:"
+            f"{plan.session_id >> 8 & 0xff:02x}:{plan.session_id & 0xff:02x}")
+    if plan.path == '/scratch/bt':
+        ReplayEV3(plan, addr, name, speed)
+    else:
+        ReplayBLEDevice(plan, addr, name, speed)
+    return name
+
+
+async def replay_session(url, plan, name, speed, start, results):
+    async def wait_until(t):
+        if speed:
+            delay = start + t / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    await wait_until(plan.start)
+    session_start = start + (plan.start / speed if speed else 0)
+    pending = []
+    try:
+        async with websockets.connect(url + plan.path, max_queue=None) as ws:
+            client = ReplayClient(ws, results)
+            reader = asyncio.create_task(client.read())
+            base = plan.start
+            for t, req in plan.requests:
+                await wait_until(base + t)
+                method, params = req['method'], req.get('params', {})
+                if method == 'connect':
+                    params['peripheralId'] = await client.find(
+                        name, session_start)
+                    await client.call(method, params)
+                    results.connected += 1
+                elif method == 'discover':
+                    await client.call(method, params)
+                else:
+                    pending.append(asyncio.create_task(
+                        client.call(method, params)))
+            await wait_until(base + plan.end)
+            await asyncio.gather(*pending, return_exceptions=True)
+            reader.cancel()
+    except Exception as e:
+        results.errors += 1
+        print(f"session {plan.session_id} failed: {e}", file=sys.stderr)
+
+
+async def run(args, server_args):
+    scratch_link.logger.setLevel(logging.WARNING)
+    scratch_link.configure(server_args)
+    plans = [plan for plan in load_plans(args.trace) if plan.requests]
+    names = { plan.session_id: make_device(plan, args.speed)
+              for plan in plans }
+    results = Results()
+    results.recording = True
+    results.notified = 0
+    recorded = max((plan.start + plan.end for plan in plans), default=0)
+    async with websockets.serve(scratch_link.ws_handler, "127.0.0.1", 0,
+                                max_queue=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        url = f"ws://127.0.0.1:{port}"
+        start = time.perf_counter()
+        await asyncio.gather(*(replay_session(url, plan,
+                                              names[plan.session_id],
+                                              args.speed, start, results)
+                               for plan in plans))
+        elapsed = time.perf_counter() - start
+    expected = recorded / args.speed if args.speed else 0
+    return {
+        'sessions': len(plans),
+        'connected': results.connected,
+        'errors': results.errors,
+        'recorded_s': recorded,
+        'replay_s': elapsed,
+        'lag_s': elapsed - expected,
+        'requests_per_s': len(results.request_latency) / elapsed,
+        'request_p50_ms': percentile(results.request_latency, 50) * 1000,
+        'request_p99_ms': percentile(results.request_latency, 99) * 1000,
+        'notifications_recorded': sum(plan.notified() for plan in plans),
+        'notifications': results.notified,
+        'notifications_per_s': results.notified / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="trace file written by --record")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay speed, 0 for as fast as possible "
+                        "(default: 1)")
+    parser.add_argument("--save", metavar="FILE",
+                        help="write the report to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="fail when worse than the report in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression (default: 0.2)")
+    args, rest = parser.parse_known_args()
+    server_args = scratch_link.parse_args(rest)
+
+    report = asyncio.run(run(args, server_args))
+    print(f"trace={args.trace} speed={args.speed or 'max'}")
+    print(f"  sessions           {report['connected']:8d} / {report['sessions']} connected")
+    print(f"  recorded           {report['recorded_s']:8.2f} s")
+    print(f"  replay             {report['replay_s']:8.2f} s")
+    print(f"  requests/s         {report['requests_per_s']:8.0f}")
+    print(f"  request p50        {report['request_p50_ms']:8.2f} ms")
+    print(f"  request p99        {report['request_p99_ms']:8.2f} ms")
+    print(f"  notifications      {report['notifications']:8d} "
+          f"(recorded {report['notifications_recorded']})")
+
+    status = 0
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        status = 1 if regressions else 0
+    sys.stdout.flush()
+    os._exit(status)
+
+
+if __name__ == "__main__":
+    main()
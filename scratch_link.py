@@ -4,22 +4,55 @@ import struct
 
 """Scratch link on bluepy"""
 
+import argparse
 import asyncio
 import pathlib
 import ssl
 import websockets
 import json
 import base64
+import bisect
+import collections
+import functools
+import importlib
+
+# optional faster JSON encoder/decoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class LazyModule():
+    """
+    A module imported on first attribute access, so that a Bluetooth
+    stack is only loaded when a session uses it
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
 
 # for Bluetooth (e.g. Lego EV3)
-import bluetooth
+bluetooth = LazyModule('bluetooth')
 
 # for BLESession (e.g. BBC micro:bit)
-from bluepy.btle import Scanner, UUID, Peripheral, DefaultDelegate
-from bluepy.btle import BTLEDisconnectError
+btle = LazyModule('bluepy.btle')
 
+import errno
+import os
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import multiprocessing
+import pickle
+import socket
 
 # for logging
 import logging
@@ -30,13 +63,920 @@ logger.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.propagate = False
 
+class RequestDispatcher():
+    """
+    Run blocking request handlers off the event loop.
+    Handlers run on a bounded thread pool shared by all sessions. Each
+    session has its own lane so its requests are still handled one by one
+    in arrival order.
+    """
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="request")
+
+    async def dispatch(self, session, method, params):
+        async with session.lane:
+            return await session.loop.run_in_executor(
+                self.executor, session.handle_request, method, params)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class LoopMonitor():
+    """
+    Measure event loop stalls. A stall is the delay between the time a
+    periodic timer should fire and the time the loop actually runs it.
+    """
+    def __init__(self, interval=0.05, threshold=0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.total_stall = 0.0
+        self.max_stall = 0.0
+        self.stalls = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            stall = max(0.0, loop.time() - start - self.interval)
+            self.samples += 1
+            self.total_stall += stall
+            self.max_stall = max(self.max_stall, stall)
+            if stall >= self.threshold:
+                self.stalls += 1
+                logger.warning(f"event loop stalled for {stall * 1000:.0f} ms")
+
+    def report(self):
+        return { 'samples': self.samples,
+                 'stalls': self.stalls,
+                 'total_stall': self.total_stall,
+                 'max_stall': self.max_stall }
+
+    async def log_periodically(self, period):
+        while True:
+            await asyncio.sleep(period)
+            logger.info(f"event loop stall report: {self.report()}")
+            self.reset()
+
+class Histogram():
+    """Distribution of durations in seconds over fixed buckets"""
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last count is for values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def read(self):
+        """Return (counts, sum, count) consistently"""
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+class Metrics():
+    """
+    Process wide metrics: histograms and counters keyed by name and
+    labels, and gauges computed from the active sessions when read.
+    They are exposed in the Prometheus text format and as a dict for the
+    getStats request.
+    """
+    TYPES = {
+        'scratch_link_request_seconds':
+            ('histogram', "Time to handle a request from Scratch"),
+        'scratch_link_notification_seconds':
+            ('histogram', "Time from queueing a notification to sending it"),
+        'scratch_link_lock_wait_seconds':
+            ('histogram', "Time spent waiting for a session lock"),
+        'scratch_link_scan_seconds':
+            ('histogram', "Duration of device scans"),
+        'scratch_link_notifications_dropped_total':
+            ('counter', "Notifications dropped by the send queue policy"),
+        'scratch_link_sessions':
+            ('gauge', "Active sessions"),
+        'scratch_link_send_queue_depth':
+            ('gauge', "Notifications waiting to be sent"),
+        'scratch_link_adapter_connections':
+            ('gauge', "BLE connections per HCI adapter"),
+        'scratch_link_adapter_scanning':
+            ('gauge', "1 for the HCI adapter the BLE scan runs on"),
+        'scratch_link_worker_sessions':
+            ('gauge', "Sessions per worker process"),
+        'scratch_link_connections':
+            ('gauge', "Device connections counted against the limit"),
+        'scratch_link_sessions_rejected_total':
+            ('counter', "Sessions refused at the session limit"),
+        'scratch_link_connections_rejected_total':
+            ('counter', "Connect requests refused at the connection limit"),
+        'scratch_link_sessions_reaped_total':
+            ('counter', "Sessions closed for being idle"),
+        'scratch_link_notifications_suppressed_total':
+            ('counter', "Device notifications not sent by the throttle, "
+             "as duplicates or over the rate limit"),
+        'scratch_link_bt_sends_refused_total':
+            ('counter', "BT sends refused with the send buffer full"),
+        'scratch_link_worker_restarts_total':
+            ('counter', "Worker processes restarted after exiting"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.sessions = set()
+        self.collectors = [self.session_gauges]
+
+    def histogram(self, name, **labels):
+        """Return the histogram of a name and labels, creating it once"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_collector(self, collector):
+        """
+        Add a callable returning gauges to report, as a dict of name to a
+        list of (labels, value) where labels is a tuple of (key, value).
+        """
+        self.collectors.append(collector)
+
+    def session_gauges(self):
+        sessions = collections.Counter()
+        depth = collections.Counter()
+        for session in list(self.sessions):
+            sessions[session.kind] += 1
+            depth[session.kind] += len(session.send_queue)
+        return { 'scratch_link_sessions':
+                     [((('session', kind),), n) for kind, n in sessions.items()],
+                 'scratch_link_send_queue_depth':
+                     [((('session', kind),), n) for kind, n in depth.items()] }
+
+    def gauges(self):
+        gauges = {}
+        for collector in self.collectors:
+            gauges.update(collector())
+        return gauges
+
+    def snapshot(self):
+        """Return all metrics as a dict of name to a list of series"""
+        with self.lock:
+            histograms = list(self.histograms.items())
+            counters = list(self.counters.items())
+        result = {}
+        for (name, labels), histogram in histograms:
+            counts, total, count = histogram.read()
+            result.setdefault(name, []).append(
+                dict(labels, count=count, sum=total))
+        for (name, labels), value in counters:
+            result.setdefault(name, []).append(dict(labels, value=value))
+        for name, values in self.gauges().items():
+            result[name] = [dict(labels, value=value)
+                            for labels, value in values]
+        return result
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        pairs = ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels)
+        return '{' + pairs + '}'
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        with self.lock:
+            histograms = list(self.histograms.items())
+            counters = list(self.counters.items())
+        lines = collections.defaultdict(list)
+        for (name, labels), histogram in histograms:
+            counts, total, count = histogram.read()
+            cumulative = 0
+            bounds = [f"{b:g}" for b in histogram.buckets] + ['+Inf']
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                le = self.format_labels(labels + (('le', bound),))
+                lines[name].append(f"{name}_bucket{le} {cumulative}")
+            labels = self.format_labels(labels)
+            lines[name].append(f"{name}_sum{labels} {total}")
+            lines[name].append(f"{name}_count{labels} {count}")
+        for (name, labels), value in counters:
+            lines[name].append(f"{name}{self.format_labels(labels)} {value}")
+        for name, values in self.gauges().items():
+            for labels, value in values:
+                lines[name].append(f"{name}{self.format_labels(labels)} {value}")
+        out = []
+        for name in sorted(lines):
+            kind, help = self.TYPES[name]
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines[name])
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+class SendQueue():
+    """
+    Bounded queue of outbound websocket messages for one session, drained
+    by a single writer task. Device threads enqueue without waiting for
+    the network. When the queue is full, the policy decides what happens:
+    BLOCK waits for room, DROP_OLDEST discards the oldest message and
+    LATEST_WINS replaces a queued message with the same key (e.g. the same
+    characteristic) and otherwise behaves as DROP_OLDEST.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    LATEST_WINS = 'latest-wins'
+    POLICIES = (BLOCK, DROP_OLDEST, LATEST_WINS)
+
+    def __init__(self, loop, maxsize=256, policy=BLOCK, kind=None):
+        self.loop = loop
+        self.kind = kind
+        self.loop_thread = threading.get_ident()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.cond = threading.Condition()
+        self.messages = collections.deque()
+        self.latest = {}
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        # Time from put() to websocket send
+        self.latency = LatencyRecorder()
+        self.histogram = None
+        if kind:
+            self.histogram = metrics.histogram(
+                'scratch_link_notification_seconds', session=kind)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message, key=None, block=True):
+        """
+        Enqueue a message from any thread. Without block, a full queue is
+        never waited for: a queued message with the same key is replaced,
+        or else the oldest message is dropped.
+        Raise ConnectionError when the queue is closed.
+        """
+        with self.cond:
+            if self.closed:
+                raise ConnectionError("websocket send queue is closed")
+            if self.policy == self.LATEST_WINS and key in self.latest:
+                self.latest[key][1] = message
+                self.drop()
+                return
+            while len(self.messages) >= self.maxsize:
+                # Never block the event loop itself
+                if (self.policy == self.BLOCK and block and
+                    threading.get_ident() != self.loop_thread):
+                    self.cond.wait()
+                    if self.closed:
+                        raise ConnectionError("websocket send queue is closed")
+                    continue
+                queued = None
+                if not block and key is not None:
+                    queued = next((entry for entry in self.messages
+                                   if entry[0] == key), None)
+                if queued:
+                    queued[1] = message
+                    self.drop()
+                    return
+                self.forget(self.messages.popleft())
+                self.drop()
+            entry = [key, message, time.perf_counter()]
+            self.messages.append(entry)
+            if self.policy == self.LATEST_WINS and key is not None:
+                self.latest[key] = entry
+            self.queued += 1
+            wakeup = len(self.messages) == 1
+        if wakeup:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def drop(self):
+        self.dropped += 1
+        if self.kind:
+            metrics.inc('scratch_link_notifications_dropped_total',
+                        session=self.kind)
+
+    def forget(self, entry):
+        if self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+
+    async def drain(self, websocket):
+        """Send queued messages until cancelled or the websocket fails"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                with self.cond:
+                    if not self.messages:
+                        break
+                    entry = self.messages.popleft()
+                    self.forget(entry)
+                    self.cond.notify()
+                await websocket.send(entry[1])
+                self.sent += 1
+                elapsed = time.perf_counter() - entry[2]
+                self.latency.add(elapsed)
+                if self.histogram:
+                    self.histogram.observe(elapsed)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.messages.clear()
+            self.latest.clear()
+            self.cond.notify_all()
+
+    def stats(self):
+        return { 'depth': len(self.messages),
+                 'queued': self.queued,
+                 'dropped': self.dropped,
+                 'sent': self.sent,
+                 'latency': self.latency.summary() }
+
+class JsonCodec():
+    """
+    Encode and decode JSON-RPC messages, with orjson when it is installed
+    and enabled. Messages are str, so websockets sends text frames.
+    """
+    def __init__(self, use_orjson=True):
+        self.use(use_orjson)
+
+    def use(self, use_orjson):
+        if use_orjson and orjson:
+            self.name = 'orjson'
+            self.loads = orjson.loads
+            self.dumps = lambda obj: orjson.dumps(obj).decode('utf-8')
+        else:
+            self.name = 'json'
+            self.loads = json.loads
+            self.dumps = lambda obj: json.dumps(obj, separators=(',', ':'))
+
+codec = JsonCodec()
+
+class NotificationTemplate():
+    """
+    A notification serialized once, leaving one string parameter to be
+    filled in per message, e.g. the base64 payload of a characteristic.
+    The value must not need JSON escaping.
+    """
+    MARKER = "@@value@@"
+
+    def __init__(self, method, params, field):
+        params = dict(params)
+        params[field] = self.MARKER
+        text = codec.dumps({ 'jsonrpc': "2.0", 'method': method,
+                             'params': params })
+        self.prefix, self.suffix = text.split(self.MARKER)
+
+    def render(self, value):
+        return self.prefix + value + self.suffix
+
+class NotificationPolicy():
+    """
+    How notifications of a characteristic are passed to Scratch: at most
+    max_rate per second (0 for no limit) and, with dedupe, not again when
+    the payload did not change, as Scratch would see the same value. Only
+    use dedupe for characteristics carrying state: a repeated event or
+    command reply matters.
+    """
+    def __init__(self, max_rate=0, dedupe=False):
+        self.max_rate = max_rate
+        self.interval = 1.0 / max_rate if max_rate > 0 else 0
+        self.dedupe = dedupe
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse UUID=RATE[,skip-duplicates] to (UUID or '*', policy). The
+        UUID is of a characteristic or a service, '*' matches the others.
+        """
+        key, sep, value = text.partition('=')
+        options = value.split(',')
+        try:
+            max_rate = float(options[0]) if options[0] else 0
+            key = key if key == '*' else btle.UUID(key)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f"bad policy {text}: {e}")
+        unknown = set(options[1:]) - {'skip-duplicates'}
+        if not sep or unknown:
+            raise argparse.ArgumentTypeError(
+                f"policy must be UUID=RATE[,skip-duplicates]: {text}")
+        return key, cls(max_rate, 'skip-duplicates' in options[1:])
+
+    def passes_all(self):
+        return not self.interval and not self.dedupe
+
+class NotificationThrottle():
+    """
+    Apply a NotificationPolicy to the notifications of one characteristic.
+    A notification arriving too early is held back and sent at the end of
+    the interval unless a newer one replaces it, so the last value always
+    reaches Scratch.
+    """
+    def __init__(self, session, template, key, policy):
+        self.session = session
+        self.template = template
+        self.key = key
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.last = None
+        self.last_time = float('-inf')
+        self.pending = None
+        self.sent = 0
+        self.suppressed = 0
+
+    def notify(self, data):
+        """Send or hold back data from the device, from any thread"""
+        with self.lock:
+            if self.pending is not None:
+                # The newer value replaces the one held back
+                self.pending = data
+                self.suppress('rate')
+                return
+            if self.policy.dedupe and data == self.last:
+                self.suppress('duplicate')
+                return
+            now = time.monotonic()
+            wait = self.last_time + self.policy.interval - now
+            if wait > 0:
+                self.pending = data
+                self.session.call_in_loop(self.session.loop.call_later,
+                                          wait, self.flush)
+                return
+            self.last = data
+            self.last_time = now
+            self.sent += 1
+        self.session.send_data(self.template, data, key=self.key)
+
+    def flush(self):
+        """Send the value held back, on the event loop"""
+        with self.lock:
+            data, self.pending = self.pending, None
+            if data is None:
+                return
+            if self.policy.dedupe and data == self.last:
+                self.suppress('duplicate')
+                return
+            self.last = data
+            self.last_time = time.monotonic()
+            self.sent += 1
+        try:
+            self.session.send_data(self.template, data, key=self.key)
+        except ConnectionError:
+            # The session is over
+            pass
+
+    def suppress(self, reason):
+        self.suppressed += 1
+        metrics.inc('scratch_link_notifications_suppressed_total',
+                    session=self.session.kind, reason=reason)
+
+    def stats(self):
+        return { 'sent': self.sent, 'suppressed': self.suppressed }
+
+class LatencyRecorder():
+    """Keep recent latency samples and report their percentiles"""
+    def __init__(self, size=1024):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, ps=(50, 90, 99)):
+        samples = sorted(self.samples)
+        if not samples:
+            return {}
+        return { f"p{p}": samples[min(len(samples) - 1, len(samples) * p // 100)]
+                 for p in ps }
+
+    def summary(self):
+        return dict(self.percentiles(), count=self.count)
+
+    def __str__(self):
+        ps = ' '.join(f"{k}={v * 1000:.1f}ms"
+                      for k, v in self.percentiles().items())
+        return f"n={self.count} {ps}"
+
+class ConnectionPool():
+    """
+    Keep device connections alive for a grace period after their session
+    ends, so that a new session connecting to the same device, e.g. after
+    a Scratch tab reload, gets the connection back without scanning and
+    connecting again. Connections are keyed by (kind, device address).
+    The least recently released connection is closed when the pool is
+    full.
+    """
+
+    class Entry():
+        def __init__(self, conn, info, close, expires):
+            self.conn = conn
+            self.info = info
+            self.close = close
+            self.expires = expires
+
+    def __init__(self, grace=30.0, max_size=4):
+        self.grace = grace
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def release(self, key, conn, info, close):
+        """
+        Keep a connection for reuse. info describes the device for
+        discovery; close is called to close the connection on eviction.
+        """
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                evicted.append(old)
+            self.entries[key] = self.Entry(conn, info, close,
+                                           time.monotonic() + self.grace)
+            while len(self.entries) > self.max_size:
+                evicted.append(self.entries.popitem(last=False)[1])
+        logger.info(f"keep connection to {key} for {self.grace} seconds")
+        self.close_entries(evicted)
+
+    def acquire(self, key):
+        """Take a kept connection. Return (conn, info) or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        logger.info(f"reuse connection to {key}")
+        return entry.conn, entry.info
+
+    def available(self, kind):
+        """Return [(address, info)] of kept connections of a kind"""
+        with self.lock:
+            return [(key[1], entry.info) for key, entry in self.entries.items()
+                    if key[0] == kind]
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, entry in self.entries.items()
+                       if entry.expires <= now]
+            evicted = [self.entries.pop(key) for key in expired]
+        self.close_entries(evicted)
+
+    def close_entries(self, entries):
+        for entry in entries:
+            self.evicted += 1
+            try:
+                entry.close()
+            except Exception as e:
+                logger.error(f"failed to close pooled connection: {e}")
+
+    def close_all(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        self.close_entries(entries)
+
+    async def run(self):
+        """Close expired connections periodically"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(1)
+            await loop.run_in_executor(None, self.expire)
+
+    def stats(self):
+        return { 'held': len(self.entries),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evicted': self.evicted }
+
+class TraceRecorder():
+    """
+    Append timestamped session events to a binary trace for replay. A
+    record is a header with the wall clock time, the event type, the
+    session id and the payload length, followed by the payload. When the
+    file grows over max_bytes, it is rotated to FILE.1, FILE.2 and so on,
+    keeping backups old files.
+    """
+    MAGIC = b"SLTRACE1"
+    RECORD = struct.Struct("<dBII")
+
+    OPEN = 1        # websocket path
+    CLOSE = 2       # empty
+    REQUEST = 3     # JSON-RPC text from Scratch
+    RESPONSE = 4    # JSON-RPC text to Scratch
+    NOTIFY = 5      # JSON-RPC text to Scratch
+    BLE_READ = 6    # characteristic and value read
+    BLE_WRITE = 7   # characteristic and value written
+    BLE_NOTIFY = 8  # characteristic and value notified
+    BT_RECV = 9     # RFCOMM frame received
+    BT_SEND = 10    # RFCOMM bytes sent
+
+    CHARA = struct.Struct("<B")
+
+    def __init__(self, path, max_bytes=64 << 20, backups=5):
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.next_session_id = 0
+        self.file = None
+        self.size = 0
+        self.open_file()
+
+    def open_file(self):
+        self.file = open(self.path, 'ab', buffering=1 << 16)
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(self.MAGIC)
+            self.size = len(self.MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for n in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{n}")
+            if older.exists():
+                older.replace(self.path.with_name(f"{self.path.name}.{n + 1}"))
+        if self.backups > 0:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self.open_file()
+
+    def write(self, event, session_id, payload=b""):
+        """Append an event from any thread"""
+        header = self.RECORD.pack(time.time(), event, session_id, len(payload))
+        with self.lock:
+            if self.size >= self.max_bytes:
+                self.rotate()
+            self.file.write(header)
+            self.file.write(payload)
+            self.size += len(header) + len(payload)
+
+    def open_session(self, path):
+        """Record a new session and return its id"""
+        with self.lock:
+            self.next_session_id += 1
+            session_id = self.next_session_id
+        self.write(self.OPEN, session_id, path.encode('utf-8'))
+        return session_id
+
+    def close_session(self, session_id):
+        self.write(self.CLOSE, session_id)
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    @classmethod
+    def chara_payload(cls, chara_id, data):
+        chara = str(chara_id).encode('ascii')
+        return cls.CHARA.pack(len(chara)) + chara + bytes(data)
+
+    @classmethod
+    def split_chara_payload(cls, payload):
+        """Return (characteristic ID, data) of a BLE event payload"""
+        [length] = cls.CHARA.unpack_from(payload)
+        start = cls.CHARA.size
+        return (payload[start:start + length].decode('ascii'),
+                payload[start + length:])
+
+    @classmethod
+    def files(cls, path):
+        """Return the files of a trace, oldest first"""
+        path = pathlib.Path(path)
+        backups = sorted(path.parent.glob(f"{path.name}.[0-9]*"),
+                         key=lambda p: int(p.suffix[1:]), reverse=True)
+        return backups + ([path] if path.exists() else [])
+
+    @classmethod
+    def read(cls, path):
+        """Yield (time, event, session id, payload) of a trace and its backups"""
+        for name in cls.files(path):
+            with open(name, 'rb') as f:
+                if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                    raise ValueError(f"{name} is not a scratch_link trace")
+                while True:
+                    header = f.read(cls.RECORD.size)
+                    if len(header) < cls.RECORD.size:
+                        break
+                    t, event, session_id, length = cls.RECORD.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        break
+                    yield t, event, session_id, payload
+
+class SessionSupervisor():
+    """
+    Track every session from websocket open until its device is released
+    and its device thread has exited. Sessions beyond max_sessions are
+    refused, and connect requests beyond max_connections device
+    connections fail. Sessions without a device connection which neither
+    got a request nor sent anything for idle_timeout seconds are closed.
+    A connected device may stay quiet for long, and keepalive pings find
+    dead websockets. A limit of 0 means no limit.
+    """
+
+    # Seconds to wait for device threads after a session closed
+    join_timeout = 3.0
+
+    def __init__(self, max_sessions=0, max_connections=0, idle_timeout=0,
+                 keepalive=20):
+        self.max_sessions = max_sessions
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.admitted = 0
+        # session -> [activity seen last, time it changed]
+        self.sessions = {}
+        # session -> True once its connect request succeeded
+        self.connections = {}
+        self.rejected = 0
+        self.reaped = 0
+        self.leaked = 0
+        metrics.add_collector(self.gauges)
+
+    def serve_options(self):
+        """Keyword arguments of websockets.serve for keepalive pings"""
+        keepalive = self.keepalive or None
+        return { 'ping_interval': keepalive, 'ping_timeout': keepalive }
+
+    def admit(self):
+        """Reserve a session slot. Return False when there is none left."""
+        if self.max_sessions and self.admitted >= self.max_sessions:
+            self.rejected += 1
+            metrics.inc('scratch_link_sessions_rejected_total')
+            return False
+        self.admitted += 1
+        return True
+
+    def track(self, session):
+        self.sessions[session] = [session.activity(), time.monotonic()]
+
+    def connect(self, session):
+        """
+        Count a device connection of a tracked session before its connect
+        request is handled. Return False when max_connections are in use.
+        """
+        if session not in self.sessions or session in self.connections:
+            return True
+        if (self.max_connections and
+            len(self.connections) >= self.max_connections):
+            metrics.inc('scratch_link_connections_rejected_total')
+            return False
+        self.connections[session] = False
+        return True
+
+    def connect_done(self, session, jsonres):
+        """
+        Keep the connection counted when the connect request succeeded,
+        otherwise release it. A session connected before keeps its count
+        whatever a later connect request returns.
+        """
+        if self.connections.get(session) is not False:
+            return
+        if 'result' in jsonres:
+            self.connections[session] = True
+        else:
+            del self.connections[session]
+
+    async def release(self, session):
+        """
+        Uncount a session whose handler returned, and check that its
+        device threads exit.
+        """
+        self.admitted -= 1
+        if session is None:
+            return
+        self.sessions.pop(session, None)
+        self.connections.pop(session, None)
+        threads = [thread for thread in session.threads() if thread.is_alive()]
+        if not threads:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.join_timeout
+        for thread in threads:
+            await loop.run_in_executor(
+                None, thread.join, max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                self.leaked += 1
+                logger.error(f"{session.kind} session thread {thread.name} "
+                             "did not exit")
+
+    def reap(self):
+        """Close sessions idle for idle_timeout"""
+        now = time.monotonic()
+        for session, seen in list(self.sessions.items()):
+            activity = session.activity()
+            if activity != seen[0] or session in self.connections:
+                seen[0], seen[1] = activity, now
+            elif now - seen[1] >= self.idle_timeout:
+                logger.info(f"close {session.kind} session idle for "
+                            f"{now - seen[1]:.0f} s")
+                self.reaped += 1
+                metrics.inc('scratch_link_sessions_reaped_total')
+                seen[1] = now
+                asyncio.create_task(session.websocket.close(1001, "idle"))
+
+    async def run(self):
+        if not self.idle_timeout:
+            return
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 4, 10))
+            self.reap()
+
+    def gauges(self):
+        return { 'scratch_link_connections': [((), len(self.connections))] }
+
+    def stats(self):
+        return { 'sessions': len(self.sessions),
+                 'connections': len(self.connections),
+                 'rejected': self.rejected,
+                 'reaped': self.reaped,
+                 'leaked_threads': self.leaked }
+
 class Session():
     """Base class for BTSession and BLESession"""
+
+    # Set by main(). When None, requests are handled on the event loop.
+    dispatcher = None
+    send_queue_size = 256
+    send_queue_policy = SendQueue.BLOCK
+
+    # 'thread' polls the device from a thread per session, 'asyncio'
+    # watches device file descriptors with the event loop.
+    IO_BACKENDS = ('thread', 'asyncio')
+    io_backend = 'thread'
+
+    # Set by main() to keep connections across sessions
+    pool = None
+
+    # WorkerPool set by main() to run device sessions in worker processes
+    workers = None
+
+    # Limits and idle timeout configured by main()
+    supervisor = SessionSupervisor()
+
+    # TraceRecorder set by main() to record sessions
+    recorder = None
+
+    # Session type label of metrics, and the requests timed by method.
+    # Other requests are timed as 'other'.
+    kind = 'session'
+    methods = ()
+
+    # Request answered with the metrics of the session and the process
+    STATS_METHOD = 'getStats'
+
     def __init__(self, websocket, loop):
         self.websocket = websocket
         self.loop = loop
+        self.loop_thread = threading.get_ident()
         self.lock = threading.RLock()
+        self.lane = asyncio.Lock()
+        self.deferred_tasks = set()
         self.notification = None
+        self.send_queue = SendQueue(loop, self.send_queue_size,
+                                    self.send_queue_policy, self.kind)
+        self.request_time = {}
+        self.trace_id = None
+        self.request_count = 0
+        self.lock_wait = LatencyRecorder()
+        self.lock_wait_histogram = metrics.histogram(
+            'scratch_link_lock_wait_seconds', session=self.kind)
 
     async def recv_request(self):
         """
@@ -44,18 +984,58 @@ class Session():
         Return True when the sessino should end.
         """
         logger.debug("start recv_request")
-        req = await self.websocket.recv()
-        logger.debug(f"request: {req}")
-        jsonreq = json.loads(req)
+        jsonreq = await self.recv_jsonreq()
         if jsonreq['jsonrpc'] != '2.0':
             logger.error("error: jsonrpc versino is not 2.0")
             return
-        jsonres = self.handle_request(jsonreq['method'], jsonreq['params'])
+        start = time.perf_counter()
+        method = jsonreq['method']
+        self.request_count += 1
+        if method == 'connect' and not self.supervisor.connect(self):
+            return await self.respond(jsonreq, self.too_many_connections())
+        if method == self.STATS_METHOD:
+            jsonres = { "jsonrpc": "2.0",
+                        "result": { 'session': self.stats(),
+                                    'global': metrics.snapshot() } }
+            return await self.respond(jsonreq, jsonres)
+        deferred = self.defer_request(method, jsonreq['params'])
+        if deferred:
+            task = asyncio.create_task(
+                self.respond_later(jsonreq, deferred, start))
+            self.deferred_tasks.add(task)
+            task.add_done_callback(self.deferred_tasks.discard)
+            return False
+        if self.dispatcher:
+            jsonres = await self.dispatcher.dispatch(
+                self, method, jsonreq['params'])
+        else:
+            jsonres = self.handle_request(method, jsonreq['params'])
+        self.observe_request(method, time.perf_counter() - start)
+        return await self.respond(jsonreq, jsonres)
+
+    async def recv_jsonreq(self):
+        """Receive a request from Scratch and parse it"""
+        req = await self.websocket.recv()
+        logger.debug("request: %s", req)
+        if self.recorder:
+            self.record(TraceRecorder.REQUEST, req.encode('utf-8'))
+        return codec.loads(req)
+
+    async def send_jsonres(self, jsonres):
+        """Serialize a response and send it to Scratch"""
+        response = codec.dumps(jsonres)
+        logger.debug("response: %s", response)
+        if self.recorder:
+            self.record(TraceRecorder.RESPONSE, response.encode('utf-8'))
+        await self.websocket.send(response)
+
+    async def respond(self, jsonreq, jsonres):
+        """Send the response. Return True when the session should end."""
+        if jsonreq['method'] == 'connect':
+            self.supervisor.connect_done(self, jsonres)
         if 'id' in jsonreq:
             jsonres['id'] = jsonreq['id']
-        response = json.dumps(jsonres)
-        logger.debug(f"response: {response}")
-        await self.websocket.send(response)
+        await self.send_jsonres(jsonres)
         if self.end_request():
             return True
         return False
@@ -64,6 +1044,65 @@ class Session():
         """Default request handler"""
         logger.debug(f"default handle_request: {method}, {params}")
 
+    def defer_request(self, method, params):
+        """
+        Default hook to handle a request without holding up the next one.
+        Return an awaitable resolving to the response, or None to handle
+        the request with handle_request.
+        """
+        return None
+
+    async def respond_later(self, jsonreq, deferred, start):
+        try:
+            jsonres = await deferred
+        except Exception as e:
+            logger.error(f"failed to handle {jsonreq['method']}: {e}")
+            jsonres = { "jsonrpc": "2.0", "error": { "message": str(e) } }
+        self.observe_request(jsonreq['method'], time.perf_counter() - start)
+        if 'id' in jsonreq:
+            jsonres['id'] = jsonreq['id']
+        await self.send_jsonres(jsonres)
+
+    def record(self, event, payload=b""):
+        """Record an event of this session when it is traced"""
+        if self.trace_id is not None:
+            self.recorder.write(event, self.trace_id, payload)
+
+    def too_many_connections(self):
+        return { "jsonrpc": "2.0",
+                 "error": { "message": "too many device connections" } }
+
+    def activity(self):
+        """Return a value which changes whenever the session is used"""
+        return (self.request_count, self.send_queue.queued)
+
+    def threads(self):
+        """Return the device threads of the session"""
+        return []
+
+    def observe_request(self, method, seconds):
+        if method not in self.methods:
+            method = 'other'
+        recorder = self.request_time.get(method)
+        if recorder is None:
+            recorder = self.request_time[method] = LatencyRecorder()
+        recorder.add(seconds)
+        metrics.histogram('scratch_link_request_seconds',
+                          session=self.kind, method=method).observe(seconds)
+
+    def observe_lock_wait(self, seconds):
+        self.lock_wait.add(seconds)
+        self.lock_wait_histogram.observe(seconds)
+
+    def stats(self):
+        """Return metrics of this session"""
+        return { 'type': self.kind,
+                 'status': getattr(self, 'status', None),
+                 'requests': { method: recorder.summary() for method, recorder
+                               in self.request_time.items() },
+                 'lock_wait': self.lock_wait.summary(),
+                 'send_queue': self.send_queue.stats() }
+
     def end_request(self):
         """
         Default callback at request end. This callback is required to
@@ -73,127 +1112,503 @@ class Session():
         logger.debug("default end_request")
         return False
 
-    def notify(self, method, params):
+    def close(self):
+        """Default callback to release the device at session end"""
+        logger.debug("default close")
+
+    def call_in_loop(self, callback, *args, wait=False):
         """
-        Notify BT/BLE device events to scratch.
+        Run callback on the event loop thread, e.g. to add or remove fd
+        readers. With wait, return after the callback has run.
+        """
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+            return
+        if self.loop.is_closed():
+            return
+        if not wait or not self.loop.is_running():
+            self.loop.call_soon_threadsafe(callback, *args)
+            return
+        done = threading.Event()
+        def run():
+            try:
+                callback(*args)
+            finally:
+                done.set()
+        self.loop.call_soon_threadsafe(run)
+        done.wait()
+
+    def abort(self, reason):
+        """End the session from any thread, e.g. when its device thread died"""
+        logger.info(f"end session: {reason}")
+        self.call_in_loop(self.close_websocket, reason)
+
+    def close_websocket(self, reason):
+        task = asyncio.create_task(self.websocket.close(1011, reason))
+        self.deferred_tasks.add(task)
+        task.add_done_callback(self.deferred_tasks.discard)
+
+    def notify(self, method, params, key=None, block=True):
+        """
+        Notify BT/BLE device events to scratch. The notification is queued
+        and sent by the writer task. With the latest-wins policy, a queued
+        notification with the same key is replaced. Without block, a full
+        queue does not hold up the caller, see SendQueue.put().
+        Raise ConnectionError when the websocket is gone.
         """
-        logger.debug("start to notify")
-
         jsonn = { 'jsonrpc': "2.0", 'method': method }
         jsonn['params'] = params
-        notification = json.dumps(jsonn)
-        logger.debug(f"notification: {notification}")
-
-        future = asyncio.run_coroutine_threadsafe(
-            self.websocket.send(notification), self.loop)
-        result = future.result()
+        self.send_notification(codec.dumps(jsonn), key, block)
+
+    def send_notification(self, notification, key=None, block=True):
+        """Queue a serialized notification, see notify()"""
+        logger.debug("notification: %s", notification)
+        if self.recorder:
+            self.record(TraceRecorder.NOTIFY, notification.encode('utf-8'))
+        self.send_queue.put(notification, key, block)
+
+    def send_data(self, template, data, key=None):
+        """Notify bytes from the device with a NotificationTemplate"""
+        message = base64.standard_b64encode(data).decode('ascii')
+        self.send_notification(template.render(message), key)
+
+    def decode_message(self, params):
+        """Return the bytes of the message of a send or write request"""
+        if params['encoding'] != 'base64':
+            logger.error("encoding other than base 64 is not "
+                         "yet supported: ", params['encoding'])
+        msg_bstr = params['message'].encode('ascii')
+        return base64.standard_b64decode(msg_bstr)
+
+    def writer_done(self, task):
+        e = None if task.cancelled() else task.exception()
+        if isinstance(e, websockets.ConnectionClosedOK):
+            logger.debug(f"websocket closed while notifying: {e}")
+        elif e:
+            logger.error(f"failed to send notification: {e}")
+        # Let device threads know through notify() that the session is over
+        self.send_queue.close()
 
     async def handle(self):
         logger.debug("start session hanlder")
-        await self.recv_request()
-        await asyncio.sleep(0.1)
-        while True:
-            if await self.recv_request():
+        writer = asyncio.create_task(self.send_queue.drain(self.websocket))
+        writer.add_done_callback(self.writer_done)
+        metrics.sessions.add(self)
+        try:
+            await self.recv_request()
+            await asyncio.sleep(0.1)
+            while True:
+                if await self.recv_request():
+                    break
+                logger.debug("in handle loop")
+        finally:
+            metrics.sessions.discard(self)
+            writer.cancel()
+            for task in self.deferred_tasks:
+                task.cancel()
+            # Release the device as soon as Scratch has gone
+            await self.loop.run_in_executor(None, self.close)
+
+class FrameReader():
+    """
+    Split a RFCOMM byte stream into length-prefixed frames such as EV3
+    messages: a little-endian 16-bit length followed by that many bytes.
+    Bytes are received into a preallocated buffer and complete frames are
+    returned as memoryview slices of it, so no per-frame allocation is
+    needed. Partial frames stay in the buffer until the rest arrives.
+    """
+
+    HEADER = struct.Struct("<H")
+    # Large enough for two frames of the maximum length
+    BUFFER_SIZE = 2 * (HEADER.size + 0xFFFF)
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def fill(self, sock):
+        """
+        Receive available bytes from the socket.
+        Return the number of bytes received, 0 when the peer closed.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < self.HEADER.size + 0xFFFF:
+            self.compact()
+        free = self.view[self.end:]
+        recv_into = getattr(sock, 'recv_into', None)
+        if recv_into:
+            n = recv_into(free)
+        else:
+            # pybluez sockets may lack recv_into
+            data = sock.recv(len(free))
+            n = len(data)
+            free[:n] = data
+        self.end += n
+        return n
+
+    def compact(self):
+        size = self.end - self.start
+        self.buf[:size] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    def frames(self):
+        """
+        Return (start, end) offsets in view of every complete frame
+        received so far and consume them.
+        """
+        frames = []
+        while self.end - self.start >= self.HEADER.size:
+            [length] = self.HEADER.unpack_from(self.buf, self.start)
+            frame_end = self.start + self.HEADER.size + length
+            if frame_end > self.end:
+                break
+            frames.append((self.start, frame_end))
+            self.start = frame_end
+        return frames
+
+class FrameWriter():
+    """
+    Buffer the frames a session sends to its RFCOMM socket and send them
+    from the event loop without blocking it. Frames queued in the same loop
+    iteration, or while the socket cannot take more, go out in one send.
+    What a short send leaves stays at the head of the buffer until the
+    socket is writable again. A frame which does not fit in max_bytes is
+    refused, so that Scratch gets an error instead of the loop waiting.
+    """
+
+    def __init__(self, session, max_bytes=64 << 10):
+        self.session = session
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        # (stream offset of the end of a frame, future), oldest first
+        self.waiters = collections.deque()
+        self.fd = None
+        self.scheduled = False
+        # Stream offsets of the bytes queued and sent
+        self.queued = 0
+        self.sent = 0
+        self.frames = 0
+        self.sends = 0
+        self.refused = 0
+
+    def submit(self, data):
+        """
+        Queue a frame. Return a future which is done when all of it has
+        been sent, or None when the buffer has no room for it.
+        """
+        if len(self.buffer) + len(data) > self.max_bytes:
+            self.refused += 1
+            return None
+        future = self.session.loop.create_future()
+        self.buffer += data
+        self.queued += len(data)
+        self.frames += 1
+        self.waiters.append((self.queued, future))
+        if not self.scheduled and self.fd is None:
+            self.scheduled = True
+            self.session.loop.call_soon(self.flush)
+        return future
+
+    def pending(self):
+        return bool(self.buffer or self.waiters)
+
+    def flush(self):
+        """Send as much of the buffer as the socket takes"""
+        self.scheduled = False
+        sock = self.session.sock
+        if sock is None:
+            self.fail(ConnectionError("BT socket closed"))
+            return
+        while self.buffer:
+            try:
+                # pybluez sockets only take bytes
+                n = sock.send(bytes(self.buffer), socket.MSG_DONTWAIT)
+            except Exception as e:
+                if self.would_block(e):
+                    break
+                self.fail(e)
+                return
+            if not n:
                 break
-            logger.debug("in handle loop")
+            self.sends += 1
+            del self.buffer[:n]
+            self.sent += n
+            while self.waiters and self.waiters[0][0] <= self.sent:
+                end, future = self.waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+        if self.buffer and self.fd is None:
+            self.fd = sock.fileno()
+            self.session.loop.add_writer(self.fd, self.flush)
+        elif not self.buffer:
+            self.unwatch()
+
+    @staticmethod
+    def would_block(e):
+        """
+        Return True when a send failed only because the socket is full.
+        pybluez raises a BluetoothError, an OSError, with errno EAGAIN.
+        """
+        if not isinstance(e, OSError):
+            return False
+        code = e.errno if e.errno is not None else (e.args or [None])[0]
+        return code in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+    def unwatch(self):
+        if self.fd is not None:
+            self.session.loop.remove_writer(self.fd)
+            self.fd = None
+
+    def fail(self, e):
+        """Drop the buffer and fail the frames waiting in it"""
+        self.unwatch()
+        self.buffer.clear()
+        self.sent = self.queued
+        while self.waiters:
+            end, future = self.waiters.popleft()
+            if not future.done():
+                future.set_exception(e)
+
+    def close(self):
+        self.fail(ConnectionError("BT socket closed"))
+
+    def stats(self):
+        return { 'depth': len(self.buffer),
+                 'frames': self.frames,
+                 'sends': self.sends,
+                 'sent': self.sent,
+                 'refused': self.refused }
+
+class BTInquiry():
+    """
+    Bluetooth inquiry shared by all discovering BT sessions. Sessions
+    subscribe a callback, which is called with (address, device class,
+    name, rssi) of every device found. Inquiries repeat while there are
+    subscribers. They do not look up names: the name of a device whose
+    class a subscriber wants is resolved on a separate thread and the
+    device is passed to the subscribers again with it. Devices found within
+    ttl seconds are kept with their class, name and last rssi and passed to
+    new subscribers immediately.
+    """
+
+    # bluetooth.DeviceDiscoverer subclass, defined on the first inquiry
+    discoverer_class = None
+
+    @classmethod
+    def make_discoverer(cls, inquiry):
+        if cls.discoverer_class is None:
+            class Discoverer(bluetooth.DeviceDiscoverer):
+                def __init__(self, inquiry):
+                    super().__init__()
+                    self.inquiry = inquiry
+                    self.done = False
+
+                def pre_inquiry(self):
+                    self.done = False
+
+                def device_discovered(self, address, device_class, rssi, name):
+                    logger.debug(f"Found device {name} addr={address} class={device_class} rssi={rssi}")
+                    if isinstance(name, bytes):
+                        name = name.decode('utf-8', 'replace')
+                    self.inquiry.found(address, device_class, name, rssi)
+
+                def inquiry_complete(self):
+                    self.done = True
+
+            cls.discoverer_class = Discoverer
+        return cls.discoverer_class(inquiry)
+
+    def __init__(self, ttl=60.0, name_timeout=10):
+        self.ttl = ttl
+        self.name_timeout = name_timeout
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+        self.resolver = None
+        self.names_to_resolve = collections.deque()
+        # addr -> [device class, name or None, rssi, time last seen]
+        self.devices = {}
+        self.next_prune = 0
+
+    def subscribe(self, callback, wants=None):
+        """
+        Call callback for every device found from now on. Devices found
+        within ttl are passed to it immediately. wants(device class) tells
+        which devices need their names looked up for the subscriber.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.subscribers.append((callback, wants))
+            recent = [(addr, device_class, name, rssi) for addr,
+                      (device_class, name, rssi, seen) in self.devices.items()
+                      if now - seen < self.ttl]
+            for addr, device_class, name, rssi in recent:
+                if name is None and (wants is None or wants(device_class)):
+                    self.resolve_name(addr)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        for device in recent:
+            callback(*device)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [(subscriber, wants) for subscriber, wants
+                                in self.subscribers if subscriber != callback]
+
+    def wanted(self, device_class):
+        """
+        Return True when a subscriber wants devices of the class.
+        Called with the lock held.
+        """
+        return any(wants is None or wants(device_class)
+                   for callback, wants in self.subscribers)
+
+    def found(self, addr, device_class, name, rssi):
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_prune:
+                self.prune(now)
+            entry = self.devices.get(addr)
+            if entry is None:
+                entry = self.devices[addr] = [device_class, None, rssi, 0]
+            entry[0] = device_class
+            entry[1] = name or entry[1]
+            entry[2] = rssi
+            entry[3] = now
+            name = entry[1]
+            if name is None and self.wanted(device_class):
+                self.resolve_name(addr)
+        self.dispatch(addr, device_class, name, rssi)
+
+    def prune(self, now):
+        """Forget devices not found within ttl. Called with the lock held."""
+        self.devices = { addr: entry for addr, entry in self.devices.items()
+                         if now - entry[3] < self.ttl }
+        self.next_prune = now + self.ttl
+
+    def resolve_name(self, addr):
+        """Queue a name lookup. Called with the lock held."""
+        if addr in self.names_to_resolve:
+            return
+        self.names_to_resolve.append(addr)
+        if self.resolver is None:
+            self.resolver = threading.Thread(target=self.resolve_names,
+                                             daemon=True)
+            self.resolver.start()
+
+    def dispatch(self, addr, device_class, name, rssi):
+        with self.lock:
+            subscribers = [callback for callback, wants in self.subscribers]
+        for callback in subscribers:
+            callback(addr, device_class, name, rssi)
+
+    def resolve_names(self):
+        """Look up the names of devices found without one, one at a time"""
+        while True:
+            with self.lock:
+                if not self.names_to_resolve:
+                    self.resolver = None
+                    return
+                addr = self.names_to_resolve[0]
+                entry = self.devices.get(addr)
+                # Skip devices forgotten or no longer wanted meanwhile
+                if entry is None or not self.wanted(entry[0]):
+                    self.names_to_resolve.popleft()
+                    continue
+            try:
+                name = bluetooth.lookup_name(addr, timeout=self.name_timeout)
+            except Exception as e:
+                logger.error(f"failed to look up the name of {addr}: {e}")
+                name = None
+            with self.lock:
+                self.names_to_resolve.popleft()
+                entry = self.devices.get(addr)
+                if name and entry:
+                    entry[1] = name
+                    device = (addr, entry[0], name, entry[2])
+                else:
+                    device = None
+            if device:
+                logger.debug(f"resolved name of {addr}: {name}")
+                self.dispatch(*device)
+
+    def run(self):
+        logger.info("start BT inquiry")
+        try:
+            while True:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        break
+                start = time.monotonic()
+                discoverer = self.make_discoverer(self)
+                discoverer.find_devices(lookup_names=False)
+                while not discoverer.done:
+                    with self.lock:
+                        if not self.subscribers:
+                            break
+                    readable = select.select([discoverer], [], [], 0.5)[0]
+                    if discoverer in readable:
+                        discoverer.process_event()
+                if not discoverer.done:
+                    discoverer.cancel_inquiry()
+                metrics.histogram('scratch_link_scan_seconds', session='bt'
+                                  ).observe(time.monotonic() - start)
+        except Exception as e:
+            logger.error(f"BT inquiry failed: {e}")
+            with self.lock:
+                self.thread = None
+        logger.info("stop BT inquiry")
 
 class BTSession(Session):
     """Manage a session for Bluetooth device"""
 
+    kind = 'bt'
+    methods = ('discover', 'connect', 'send')
+
     INITIAL = 1
     DISCOVERY = 2
     DISCOVERY_COMPLETE = 3
     CONNECTED = 4
     DONE = 5
 
-    # Split this into discovery thread and communication thread
-    # discovery thread should auto-terminate
-
     class BTThread(threading.Thread):
         """
         Separated thread to control notifications to Scratch.
-        It handles device discovery notification in DISCOVERY status
-        and notifications from bluetooth devices in CONNECTED status.
+        It handles notifications from bluetooth devices in CONNECTED status.
         """
 
-        class BTDiscoverer(bluetooth.DeviceDiscoverer):
-
-            def __init__(self, major_class, minor_class):
-                super().__init__()
-                self.major_class = major_class
-                self.minor_class = minor_class
-                self.found_devices = {}
-                self.done = False
-
-            def pre_inquiry(self):
-                self.done = False
-
-            def device_discovered(self, address, device_class, rssi, name):
-                logger.debug(f"Found device {name} addr={address} class={device_class} rssi={rssi}")
-                major_class = (device_class & 0x1F00) >> 8
-                minor_class = (device_class & 0xFF) >> 2
-                if major_class == self.major_class and minor_class == self.minor_class:
-                    self.found_devices[address] = (name, device_class, rssi)
-
-            def inquiry_complete(self):
-                self.done = True
-
-        def __init__(self, session, major_device_class, minor_device_class):
-            threading.Thread.__init__(self)
+        def __init__(self, session):
+            threading.Thread.__init__(self, name="bt-session")
             self.session = session
-            self.major_device_class = major_device_class
-            self.minor_device_class = minor_device_class
-            self.cancel_discovery = False
-            self.ping_time = None
-
-        def discover(self):
-            discoverer = self.BTDiscoverer(self.major_device_class, self.minor_device_class)
-            discoverer.find_devices(lookup_names=True)
-            while self.session.status == self.session.DISCOVERY and not discoverer.done and not self.cancel_discovery:
-                readable = select.select([discoverer], [], [], 0.5)[0]
-                if discoverer in readable:
-                    discoverer.process_event()
-                    for addr, (device_name, device_class, rssi) in discoverer.found_devices.items():
-                        logger.debug(f"notifying discovered {addr}: {device_name}")
-                        params = {"rssi": rssi, 'peripheralId': addr, 'name': device_name.decode("utf-8")}
-                        self.session.notify('didDiscoverPeripheral', params)
-                    discoverer.found_devices.clear()
-
-            if not discoverer.done:
-                discoverer.cancel_inquiry()
 
         def run(self):
             while self.session.status != self.session.DONE:
 
                 logger.debug("loop in BT thread")
-                current_time = int(round(time.time()))
-
-                if self.session.status == self.session.DISCOVERY and not self.cancel_discovery:
-                    logger.debug("in discovery status:")
-                    try:
-                        self.discover()
-                        self.ping_time = current_time + 5
-                    finally:
-                        self.session.status = self.session.DISCOVERY_COMPLETE
 
-                elif self.session.status == self.session.CONNECTED:
+                if self.session.status == self.session.CONNECTED:
                     logger.debug("in connected status:")
                     sock = self.session.sock
                     try:
                         ready = select.select([sock], [], [], 1)
-                        if ready[0]:
-                            header = sock.recv(2)
-                            [msg_len] = struct.unpack("<H", header)
-                            msg_data = sock.recv(msg_len)
-                            data = header + msg_data
-                            params = {'message': base64.standard_b64encode(data).decode('utf-8'), "encoding": "base64"}
-                            self.session.notify('didReceiveMessage', params)
-                            self.ping_time = current_time + 5
+                        with self.session.lock:
+                            # The socket may have been released meanwhile
+                            if ready[0] and self.session.sock is sock:
+                                if self.session.reader.fill(sock) == 0:
+                                    raise ConnectionError("BT socket closed")
+                                self.session.notify_frames()
 
                     except Exception as e:
+                        if self.session.status != self.session.DONE:
                             logger.error(e)
                             self.session.close()
-                            break
+                        break
 
                     # To avoid repeated lock by this single thread,
                     # yield CPU to other lock waiting threads.
@@ -202,30 +1617,143 @@ class BTSession(Session):
                     # Nothing to do:
                     time.sleep(1)
 
-                # Terminate if we have lost websocket connection to Scratch (e.g. browser closed)
-                if self.ping_time is None or self.ping_time <= current_time:
-                    try:
-                        self.session.notify('ping', {})
-                        self.ping_time = current_time + 5
-                    except Exception as e:
-                        logger.error(e)
-                        self.session.close()
-                        break
+    # Shared by all sessions
+    inquiry = BTInquiry()
+
+    # Send all frames received at once as one message
+    batch_frames = False
+    # Bytes waiting to be sent to the device before sends are refused
+    send_buffer_size = 64 << 10
+
+    message_template = NotificationTemplate(
+        'didReceiveMessage', { "encoding": "base64" }, 'message')
 
     def __init__(self, websocket, loop):
         super().__init__(websocket, loop)
         self.status = self.INITIAL
         self.sock = None
         self.bt_thread = None
+        self.reader = FrameReader()
+        self.writer = FrameWriter(self, self.send_buffer_size)
+        self.sock_fd = None
+        self.addr = None
+        self.device_class = None
+        # addr -> (name, device class, rssi) of the devices notified
+        self.discovered = {}
+
+    def matches(self, device_class):
+        major_class = (device_class & 0x1F00) >> 8
+        minor_class = (device_class & 0xFF) >> 2
+        return (major_class, minor_class) == self.device_class
+
+    def on_inquiry(self, addr, device_class, name, rssi):
+        """Notify a device found by the inquiry when it is new or renamed"""
+        if self.status != self.DISCOVERY or not self.matches(device_class):
+            return
+        known = self.discovered.get(addr)
+        if known and known[0] == name:
+            return
+        self.notify_device(addr, name, device_class, rssi)
+
+    def notify_device(self, addr, name, device_class, rssi):
+        logger.debug(f"notifying discovered {addr}: {name}")
+        self.discovered[addr] = (name, device_class, rssi)
+        # Until the name is resolved, show the address
+        params = {"rssi": rssi, 'peripheralId': addr, 'name': name or addr}
+        try:
+            # The inquiry thread serves all sessions: never wait for one
+            self.notify('didDiscoverPeripheral', params, key=addr,
+                        block=False)
+        except ConnectionError:
+            self.inquiry.unsubscribe(self.on_inquiry)
+
+    def notify_pooled_devices(self):
+        """Notify devices the pool keeps connections to, as discovered"""
+        for addr, (device_name, device_class, rssi) in self.pool.available('bt'):
+            if self.matches(device_class):
+                self.notify_device(addr, device_name, device_class, rssi)
+
+    def add_sock_reader(self):
+        if self.status != self.CONNECTED:
+            return
+        self.sock_fd = self.sock.fileno()
+        self.loop.add_reader(self.sock_fd, self.on_sock_readable)
+
+    def remove_sock_reader(self):
+        if self.sock_fd is not None:
+            self.loop.remove_reader(self.sock_fd)
+            self.sock_fd = None
+
+    def on_sock_readable(self):
+        try:
+            if self.reader.fill(self.sock) == 0:
+                raise ConnectionError("BT socket closed")
+            self.notify_frames()
+        except Exception as e:
+            logger.error(e)
+            self.close()
+
+    def notify_frames(self):
+        """Notify complete frames in the reader to Scratch"""
+        frames = self.reader.frames()
+        if not frames:
+            return
+        if self.batch_frames:
+            # Frames are contiguous in the buffer
+            frames = [(frames[0][0], frames[-1][1])]
+        view = self.reader.view
+        for start, end in frames:
+            if self.recorder:
+                self.record(TraceRecorder.BT_RECV, view[start:end])
+            self.send_data(self.message_template, view[start:end])
 
     def close(self):
+        connected = self.status == self.CONNECTED
         self.status = self.DONE
-        if self.sock:
-            logger.info(f"disconnect to BT socket: {self.sock}")
-            self.sock.close()
-
-    def __del__(self):
-        self.close()
+        self.inquiry.unsubscribe(self.on_inquiry)
+        if self.sock_fd is not None:
+            self.call_in_loop(self.remove_sock_reader, wait=True)
+        if self.writer.pending():
+            # A partly sent frame would garble the stream for the next user
+            connected = False
+            self.call_in_loop(self.writer.close, wait=True)
+        with self.lock:
+            sock, self.sock = self.sock, None
+        if not sock:
+            return
+        if connected and self.pool and self.addr in self.discovered:
+            self.pool.release(('bt', self.addr), (sock, self.reader),
+                              self.discovered[self.addr], sock.close)
+        else:
+            logger.info(f"disconnect to BT socket: {sock}")
+            sock.close()
+
+    def threads(self):
+        return [self.bt_thread] if self.bt_thread else []
+
+    def stats(self):
+        stats = super().stats()
+        stats['send_buffer'] = self.writer.stats()
+        return stats
+
+    def defer_request(self, method, params):
+        if self.status != self.CONNECTED or method != 'send':
+            return None
+        data = self.decode_message(params)
+        future = self.writer.submit(data)
+        if future is None:
+            metrics.inc('scratch_link_bt_sends_refused_total')
+        elif self.recorder:
+            self.record(TraceRecorder.BT_SEND, data)
+        return self.send_result(future, len(data))
+
+    async def send_result(self, future, length):
+        if future is None:
+            return { "jsonrpc": "2.0",
+                     "error": { "message": "BT send buffer full: "
+                                f"{len(self.writer.buffer)} bytes waiting" } }
+        await future
+        return { "jsonrpc": "2.0", "result": length }
 
     def handle_request(self, method, params):
         """Handle requests from Scratch"""
@@ -239,47 +1767,48 @@ class BTSession(Session):
         if self.status == self.INITIAL and method == 'discover':
             logger.debug("Starting async discovery")
             self.status = self.DISCOVERY
-            self.bt_thread = self.BTThread(self, params["majorDeviceClass"], params["minorDeviceClass"])
-            self.bt_thread.start()
+            self.device_class = (params["majorDeviceClass"],
+                                 params["minorDeviceClass"])
+            if self.pool:
+                self.notify_pooled_devices()
+            self.inquiry.subscribe(self.on_inquiry, self.matches)
+            if self.io_backend != 'asyncio':
+                self.bt_thread = self.BTThread(self)
+                self.bt_thread.start()
             res["result"] = None
 
         elif self.status in [self.DISCOVERY, self.DISCOVERY_COMPLETE] and method == 'connect':
 
-            # Cancel discovery
-            while self.status == self.DISCOVERY:
-                logger.debug("Cancelling discovery")
-                self.bt_thread.cancel_discovery = True
-                time.sleep(1)
+            # Stop discovery
+            self.inquiry.unsubscribe(self.on_inquiry)
+            self.status = self.DISCOVERY_COMPLETE
 
             addr = params['peripheralId']
-            logger.debug(f"connecting to the BT device {addr}")
-            try:
-                self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-                self.sock.connect((addr, 1))
-                logger.info(f"connected to BT device: {addr}")
-            except bluetooth.BluetoothError as e:
-                logger.error(f"failed to connect to BT device: {e}", exc_info=e)
-                self.status = self.DONE
-                self.sock = None
+            self.addr = addr
+            pooled = self.pool.acquire(('bt', addr)) if self.pool else None
+            if pooled:
+                (self.sock, self.reader), self.discovered[addr] = pooled
+            else:
+                logger.debug(f"connecting to the BT device {addr}")
+                try:
+                    self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+                    self.sock.connect((addr, 1))
+                    logger.info(f"connected to BT device: {addr}")
+                except bluetooth.BluetoothError as e:
+                    logger.error(f"failed to connect to BT device: {e}", exc_info=e)
+                    self.status = self.DONE
+                    self.sock = None
 
             if self.sock:
                 res["result"] = None
                 self.status = self.CONNECTED
+                if self.io_backend == 'asyncio':
+                    self.call_in_loop(self.add_sock_reader)
             else:
                 err_msg = f"BT connect failed: {addr}"
                 res["error"] = { "message": err_msg }
                 self.status = self.DONE
 
-        elif self.status == self.CONNECTED and method == 'send':
-            logger.debug("handle send request")
-            if params['encoding'] != 'base64':
-                logger.error("encoding other than base 64 is not "
-                                 "yet supported: ", params['encoding'])
-            msg_bstr = params['message'].encode('ascii')
-            data = base64.standard_b64decode(msg_bstr)
-            self.sock.send(data)
-            res['result'] = len(data)
-
         logger.debug(res)
         return res
 
@@ -288,144 +1817,1024 @@ class BTSession(Session):
         return self.status == self.DONE
 
 
+class GattCache():
+    """
+    Cache of BLE characteristics keyed by (device address, service UUID,
+    characteristic UUID). It is filled once at connect so that reads and
+    writes cost one ATT operation instead of GATT discovery round trips.
+    Layouts of known devices can be persisted to a JSON file; a persisted
+    layout is used only while the device's service handle ranges match.
+    """
+
+    SERVICE_CHANGED = 0x2A05
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path) if path else None
+        self.lock = threading.Lock()
+        # (addr, service uuid, characteristic uuid) -> Characteristic
+        self.entries = {}
+        # addr -> { 'services': [[service uuid, start handle, end handle],
+        #                         ...],
+        #            'characteristics': [[service uuid, characteristic uuid,
+        #                                 handle, properties, value handle],
+        #                                ...] }
+        self.layouts = {}
+        self.load()
+
+    @staticmethod
+    def key(addr, service_id, chara_id):
+        return (addr.lower(), str(btle.UUID(service_id)), str(btle.UUID(chara_id)))
+
+    def load(self):
+        if not self.path or not self.path.exists():
+            return
+        try:
+            with self.path.open() as f:
+                layouts = json.load(f)
+            # Layouts without service ranges cannot be checked: drop them
+            self.layouts = { addr: layout for addr, layout in layouts.items()
+                             if isinstance(layout, dict) }
+            logger.info(f"loaded GATT cache for {len(self.layouts)} devices")
+        except (OSError, ValueError) as e:
+            logger.error(f"failed to load GATT cache {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with tmp.open("w") as f:
+                json.dump(self.layouts, f)
+            tmp.replace(self.path)
+        except OSError as e:
+            logger.error(f"failed to save GATT cache {self.path}: {e}")
+
+    @staticmethod
+    def service_ranges(services):
+        return sorted([str(s.uuid), s.hndStart, s.hndEnd] for s in services)
+
+    def fill(self, perip):
+        """
+        Populate entries for a newly connected peripheral. Discover the
+        services in one round trip. Use the persisted layout when the
+        device is known and its service handle ranges are unchanged,
+        otherwise also discover all characteristics.
+        """
+        addr = perip.addr.lower()
+        services = perip.discoverServices().values()
+        ranges = self.service_ranges(services)
+        with self.lock:
+            layout = self.layouts.get(addr)
+        if layout is not None and layout['services'] != ranges:
+            # Handles may have moved, e.g. after a firmware update
+            logger.info(f"GATT layout of {addr} changed, discovering again")
+            layout = None
+        if layout is None:
+            charas = perip.getCharacteristics()
+            layout = { 'services': ranges, 'characteristics': [] }
+            for c in charas:
+                for s in services:
+                    if s.hndStart <= c.handle <= s.hndEnd:
+                        layout['characteristics'].append(
+                            [str(s.uuid), str(c.uuid), c.handle,
+                             c.properties, c.valHandle])
+                        break
+            with self.lock:
+                self.layouts[addr] = layout
+            self.save()
+            logger.info(f"discovered {len(layout['characteristics'])} "
+                        f"characteristics on {addr}")
+        with self.lock:
+            for service_uuid, chara_uuid, handle, props, val_handle \
+                    in layout['characteristics']:
+                c = btle.Characteristic(perip, chara_uuid, handle, props, val_handle)
+                self.entries[(addr, service_uuid, str(c.uuid))] = c
+
+    def lookup(self, perip, service_id, chara_id):
+        """
+        Return the characteristic, discovering its service on a cache miss.
+        Return None when the device does not have it.
+        """
+        key = self.key(perip.addr, service_id, chara_id)
+        with self.lock:
+            c = self.entries.get(key)
+        if c is not None:
+            return c
+        logger.debug(f"GATT cache miss: {key}")
+        try:
+            service = perip.getServiceByUUID(btle.UUID(service_id))
+            charas = service.getCharacteristics()
+        except btle.BTLEException as e:
+            logger.error(f"failed to discover service {service_id}: {e}")
+            return None
+        with self.lock:
+            for c in charas:
+                self.entries[(key[0], key[1], str(c.uuid))] = c
+            return self.entries.get(key)
+
+    def service_changed_handle(self, addr):
+        """Return the value handle of the Service Changed characteristic"""
+        layout = self.layouts.get(addr.lower())
+        if layout is None:
+            return None
+        for _, chara_uuid, _, _, val_handle in layout['characteristics']:
+            if btle.UUID(chara_uuid) == btle.UUID(self.SERVICE_CHANGED):
+                return val_handle
+        return None
+
+    def invalidate(self, addr, forget=False):
+        """
+        Drop characteristics bound to a peripheral connection. With forget,
+        also drop the device layout, e.g. after a service changed indication.
+        """
+        addr = addr.lower()
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == addr]:
+                del self.entries[key]
+            if forget:
+                self.layouts.pop(addr, None)
+        if forget:
+            self.save()
+
+class WriteScheduler():
+    """
+    Coalesce high rate writes to BLE characteristics. While a write to a
+    characteristic is in flight, newer writes to it replace each other and
+    only the latest value is written next. Every request is answered when
+    the write carrying its value or a newer one completes. The number of
+    writes in flight across characteristics is capped.
+    """
+
+    class Entry():
+        def __init__(self, data, with_response):
+            self.data = data
+            self.with_response = with_response
+            self.futures = []
+
+    def __init__(self, session, max_in_flight=1):
+        self.session = session
+        self.max_in_flight = max_in_flight
+        self.pending = {}
+        self.in_flight = set()
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+
+    def submit(self, service_id, chara_id, data, with_response=False):
+        """
+        Queue a write. Return a future which is done when the value or a
+        newer one has been written.
+        """
+        key = (service_id, chara_id)
+        future = self.session.loop.create_future()
+        entry = self.pending.get(key)
+        if entry:
+            entry.data = data
+            entry.with_response = entry.with_response or with_response
+            self.coalesced += 1
+        else:
+            entry = self.pending[key] = self.Entry(data, with_response)
+        entry.futures.append(future)
+        self.submitted += 1
+        self.kick()
+        return future
+
+    def kick(self):
+        while len(self.in_flight) < self.max_in_flight:
+            key = next((k for k in self.pending if k not in self.in_flight),
+                       None)
+            if key is None:
+                break
+            entry = self.pending.pop(key)
+            self.in_flight.add(key)
+            asyncio.create_task(self.write(key, entry))
+
+    async def write(self, key, entry):
+        dispatcher = self.session.dispatcher
+        executor = dispatcher.executor if dispatcher else None
+        try:
+            written = await self.session.loop.run_in_executor(
+                executor, self.session.write_characteristic,
+                key[0], key[1], entry.data, entry.with_response)
+            if not written:
+                raise LookupError(f"characteristic {key[1]} not found")
+            self.written += 1
+            for future in entry.futures:
+                if not future.done():
+                    future.set_result(None)
+        except Exception as e:
+            for future in entry.futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight.discard(key)
+            self.kick()
+
+    def stats(self):
+        return { 'depth': len(self.pending),
+                 'in_flight': len(self.in_flight),
+                 'submitted': self.submitted,
+                 'coalesced': self.coalesced,
+                 'written': self.written }
+
+class DiscoveryFilter():
+    """
+    Scratch BLE discovery filters compiled once for fast matching against
+    advertisements. A device matches when it matches any filter, and a
+    filter matches when all of its name, namePrefix, services and
+    manufacturerData criteria match. Service UUIDs from 16-bit, 32-bit and
+    128-bit AD types, complete or incomplete, are compared as 128-bit
+    binary UUIDs.
+    ref: https://github.com/LLK/scratch-link/blob/develop/Documentation/BluetoothLE.md
+    """
+
+    BASE_UUID_TAIL = bytes.fromhex("00001000800000805f9b34fb")
+    # AD type -> service UUID size, as ScanEntry.*_SERVICES in bluepy
+    SERVICE_AD_TYPES = {
+        0x02: 2,    # INCOMPLETE_16B_SERVICES
+        0x03: 2,    # COMPLETE_16B_SERVICES
+        0x04: 4,    # INCOMPLETE_32B_SERVICES
+        0x05: 4,    # COMPLETE_32B_SERVICES
+        0x06: 16,   # INCOMPLETE_128B_SERVICES
+        0x07: 16,   # COMPLETE_128B_SERVICES
+    }
+
+    class Filter():
+        def __init__(self, spec):
+            self.name = spec.get('name')
+            self.services = frozenset(btle.UUID(s).binVal
+                                      for s in spec.get('services', []))
+            # company ID -> (prefix length, mask, masked prefix)
+            self.manufacturer = {}
+            for company, data in spec.get('manufacturerData', {}).items():
+                prefix = bytes(data.get('dataPrefix', []))
+                mask = bytes(data.get('mask', [0xFF] * len(prefix)))
+                mask_int = int.from_bytes(mask[:len(prefix)].ljust(len(prefix), b"\xff"), 'big')
+                self.manufacturer[int(company)] = (
+                    len(prefix), mask_int,
+                    int.from_bytes(prefix, 'big') & mask_int)
+            self.has_prefix = 'namePrefix' in spec
+            self.empty = not (self.name is not None or self.services or
+                              self.manufacturer or self.has_prefix)
+
+    def __init__(self, filters):
+        self.filters = [self.Filter(f) for f in filters]
+        # Trie of name prefixes. Each node maps a character to the next
+        # node; the None key holds indices of filters ending there.
+        self.prefixes = {}
+        for i, f in enumerate(filters):
+            if 'namePrefix' in f:
+                node = self.prefixes
+                for c in f['namePrefix']:
+                    node = node.setdefault(c, {})
+                node.setdefault(None, set()).add(i)
+
+    def service_uuids(self, scan_data):
+        uuids = set()
+        for ad_type, size in self.SERVICE_AD_TYPES.items():
+            val = scan_data.get(ad_type)
+            if not val:
+                continue
+            for i in range(0, len(val) - size + 1, size):
+                uuid = val[i:i + size][::-1]
+                if size == 2:
+                    uuid = b"\x00\x00" + uuid + self.BASE_UUID_TAIL
+                elif size == 4:
+                    uuid = uuid + self.BASE_UUID_TAIL
+                uuids.add(uuid)
+        return uuids
+
+    def prefix_matches(self, name):
+        """Return indices of filters whose namePrefix the name starts with"""
+        found = set()
+        node = self.prefixes
+        for c in name:
+            found |= node.get(None, set())
+            node = node.get(c)
+            if node is None:
+                return found
+        return found | node.get(None, set())
+
+    def matches(self, dev):
+        scan_data = dev.scanData
+        uuids = None
+        name = None
+        prefixed = None
+        for i, f in enumerate(self.filters):
+            if f.empty:
+                continue
+            if f.name is not None or f.has_prefix:
+                if name is None:
+                    name = (dev.getValueText(btle.ScanEntry.COMPLETE_LOCAL_NAME) or
+                            dev.getValueText(btle.ScanEntry.SHORT_LOCAL_NAME) or "")
+                if f.name is not None and name != f.name:
+                    continue
+                if f.has_prefix:
+                    if prefixed is None:
+                        prefixed = self.prefix_matches(name)
+                    if i not in prefixed:
+                        continue
+            if f.services:
+                if uuids is None:
+                    uuids = self.service_uuids(scan_data)
+                if not f.services <= uuids:
+                    continue
+            if f.manufacturer:
+                data = scan_data.get(btle.ScanEntry.MANUFACTURER)
+                if not data or len(data) < 2:
+                    continue
+                # A device advertises data for one company only
+                expected = f.manufacturer.get(data[0] | data[1] << 8)
+                if expected is None or len(f.manufacturer) > 1:
+                    continue
+                size, mask, value = expected
+                payload = data[2:2 + size]
+                if (len(payload) < size or
+                    int.from_bytes(payload, 'big') & mask != value):
+                    continue
+            return True
+        return False
+
+class AdapterScheduler():
+    """
+    Place BLE connections and the BLE scan on HCI adapters. Every adapter
+    has its own controller with its own connection limit, so connections
+    spread over adapters scale beyond one controller. The policy chooses
+    the adapter of a new connection: least-loaded takes the adapter with
+    the fewest connections, avoiding the one scanning on ties;
+    round-robin rotates through adapters; fill uses the first adapter
+    with room, keeping the others free. The scan runs on the adapter with
+    the fewest connections.
+    """
+
+    LEAST_LOADED = 'least-loaded'
+    ROUND_ROBIN = 'round-robin'
+    FILL = 'fill'
+    POLICIES = (LEAST_LOADED, ROUND_ROBIN, FILL)
+
+    def __init__(self, adapters, policy=LEAST_LOADED, max_connections=0):
+        self.adapters = list(adapters)
+        self.policy = policy
+        # 0 for no limit
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.connections = { adapter: 0 for adapter in self.adapters }
+        self.placed = { adapter: 0 for adapter in self.adapters }
+        self.scanning = None
+        self.next = 0
+        metrics.add_collector(self.gauges)
+
+    @staticmethod
+    def detect():
+        """Return the indexes of the HCI adapters present, e.g. [0, 1]"""
+        try:
+            names = os.listdir("/sys/class/bluetooth")
+        except OSError:
+            return []
+        return sorted(int(name[3:]) for name in names
+                      if name.startswith("hci") and name[3:].isdigit())
+
+    def acquire(self):
+        """
+        Choose the adapter for a new connection and count it.
+        Return None when every adapter is full.
+        """
+        with self.lock:
+            free = [adapter for adapter in self.adapters
+                    if not self.max_connections or
+                    self.connections[adapter] < self.max_connections]
+            if not free:
+                return None
+            if self.policy == self.ROUND_ROBIN:
+                n = len(self.adapters)
+                adapter = min(free, key=lambda adapter:
+                              (self.adapters.index(adapter) - self.next) % n)
+                self.next = (self.adapters.index(adapter) + 1) % n
+            elif self.policy == self.FILL:
+                adapter = free[0]
+            else:
+                adapter = min(free, key=lambda adapter:
+                              (self.connections[adapter],
+                               adapter == self.scanning))
+            self.connections[adapter] += 1
+            self.placed[adapter] += 1
+        logger.debug(f"place BLE connection on hci{adapter}")
+        return adapter
+
+    def release(self, adapter):
+        """Uncount a connection closed on the adapter"""
+        with self.lock:
+            if self.connections.get(adapter):
+                self.connections[adapter] -= 1
+
+    def scan_adapter(self, current=None):
+        """Return the adapter to scan on, staying on current on ties"""
+        with self.lock:
+            self.scanning = min(self.adapters, key=lambda adapter:
+                                (self.connections[adapter], adapter != current))
+            return self.scanning
+
+    def scan_stopped(self):
+        with self.lock:
+            self.scanning = None
+
+    def gauges(self):
+        with self.lock:
+            return {
+                'scratch_link_adapter_connections':
+                    [((('adapter', f"hci{adapter}"),), n)
+                     for adapter, n in self.connections.items()],
+                'scratch_link_adapter_scanning':
+                    [((('adapter', f"hci{adapter}"),),
+                      int(adapter == self.scanning))
+                     for adapter in self.adapters] }
+
+    def stats(self):
+        with self.lock:
+            return { f"hci{adapter}": { 'connections': self.connections[adapter],
+                                        'placed': self.placed[adapter],
+                                        'scanning': adapter == self.scanning }
+                     for adapter in self.adapters }
+
+class BLEScanner():
+    """
+    Continuous BLE scan shared by all discovering sessions. Sessions
+    subscribe a callback, which is called with the ScanEntry of every
+    advertisement as soon as it arrives. The radio scans only while there
+    are subscribers. With adapters, the scan runs on the adapter they
+    choose and moves when another one gets less busy.
+    """
+
+    # AdapterScheduler set by main() when there are several adapters
+    adapters = None
+
+    class ScanDelegate():
+        """A bluepy scan delegate passing advertisements to the scanner"""
+        def __init__(self, scanner):
+            self.scanner = scanner
+
+        def handleDiscovery(self, dev, isNewDev, isNewData):
+            self.scanner.dispatch(dev)
+
+    def __init__(self, iface=0, replay_age=10.0):
+        self.iface = iface
+        self.replay_age = replay_age
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+        # addr -> (ScanEntry, time last seen)
+        self.devices = {}
+        self.next_prune = 0
+
+    def subscribe(self, callback, failed=None):
+        """
+        Call callback for every advertisement from now on. Devices seen
+        recently are passed to it immediately. If the scan fails, the
+        subscription is dropped and failed is called with the error.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.subscribers.append((callback, failed))
+            recent = [dev for dev, seen in self.devices.values()
+                      if now - seen < self.replay_age]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        for dev in recent:
+            callback(dev)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [(subscriber, failed) for subscriber, failed
+                                in self.subscribers if subscriber != callback]
+
+    def dispatch(self, dev):
+        now = time.monotonic()
+        with self.lock:
+            self.devices[dev.addr] = (dev, now)
+            subscribers = list(self.subscribers)
+        for callback, failed in subscribers:
+            callback(dev)
+
+    def prune(self, scanner, now):
+        """
+        Forget devices too old to replay, such as the rotating random
+        addresses of phones, here and in bluepy's own list of scan
+        results, which keeps every address until cleared.
+        """
+        with self.lock:
+            self.devices = { addr: entry for addr, entry
+                             in self.devices.items()
+                             if now - entry[1] < self.replay_age }
+        scanner.clear()
+        self.next_prune = now + self.replay_age
+
+    def run(self):
+        iface = self.adapters.scan_adapter() if self.adapters else self.iface
+        logger.info(f"start BLE scan on hci{iface}")
+        scanner = btle.Scanner(iface).withDelegate(self.ScanDelegate(self))
+        try:
+            scanner.start()
+            start = time.monotonic()
+            while True:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        break
+                scanner.process(0.5)
+                now = time.monotonic()
+                if now >= self.next_prune:
+                    self.prune(scanner, now)
+                if self.adapters:
+                    adapter = self.adapters.scan_adapter(iface)
+                    if adapter != iface:
+                        logger.info(f"move BLE scan to hci{adapter}")
+                        scanner.stop()
+                        scanner.clear()
+                        iface = adapter
+                        scanner = btle.Scanner(iface).withDelegate(
+                            self.ScanDelegate(self))
+                        scanner.start()
+            scanner.stop()
+            metrics.histogram('scratch_link_scan_seconds', session='ble'
+                              ).observe(time.monotonic() - start)
+        except Exception as e:
+            logger.error(f"BLE scan failed: {e}")
+            # Nothing scans for the subscribers any more, so end them
+            # rather than leave them discovering forever
+            with self.lock:
+                subscribers = self.subscribers
+                self.subscribers = []
+                self.thread = None
+            for callback, failed in subscribers:
+                if failed:
+                    failed(e)
+        finally:
+            if self.adapters:
+                self.adapters.scan_stopped()
+        logger.info("stop BLE scan")
+
 class BLESession(Session):
     """
     Manage a session for Bluetooth Low Energy device such as micro:bit
     """
 
+    # Shared by all sessions
+    scanner = BLEScanner()
+    # Characteristic or service UUID, or '*' -> NotificationPolicy
+    notification_policies = { '*': NotificationPolicy() }
+    # RSSI change in dBm worth notifying again during discovery
+    rssi_threshold = 5
+
+    # Shared by all sessions. Replaced by main() to persist to a file.
+    gatt_cache = GattCache()
+
+    # Set by main() to coalesce superseded writes
+    coalesce_writes = False
+    max_writes_in_flight = 1
+
+    # ATT MTU requested at connect, 0 to keep the default. Set by main().
+    request_mtu = 247
+    # Set by main() to split writes longer than the MTU allows
+    chunk_writes = False
+    DEFAULT_MTU = 23
+
+    # AdapterScheduler set by main() when there are several adapters
+    adapters = None
+
+    kind = 'ble'
+    methods = ('discover', 'connect', 'read', 'write')
+
     INITIAL = 1
     DISCOVERY = 2
     CONNECTED = 3
     DONE = 4
 
-    ADTYPE_COMP_16B = 0x3
-    ADTYPE_COMP_128B = 0x7
-
     class BLEThread(threading.Thread):
         """
-        Separated thread to control notifications to Scratch.
-        It handles device discovery notification in DISCOVERY status
-        and notifications from BLE devices in CONNECTED status.
+        Separated thread to control notifications from BLE devices to
+        Scratch in CONNECTED status. The thread owns the peripheral: requests
+        submit their bluepy calls as commands, which the thread runs as
+        soon as they arrive, between notification waits.
         """
         def __init__(self, session):
-            threading.Thread.__init__(self)
+            threading.Thread.__init__(self, name="ble-session")
             self.session = session
+            self.commands = collections.deque()
+            self.commands_lock = threading.Lock()
+            self.accepting = True
+            self.wakeup_r, self.wakeup_w = os.pipe()
+
+        def submit(self, fn):
+            """Run fn on this thread and return its result"""
+            future = Future()
+            with self.commands_lock:
+                if not self.accepting:
+                    raise btle.BTLEDisconnectError("BLE thread stopped")
+                self.commands.append((fn, future))
+                os.write(self.wakeup_w, b"\0")
+            return future.result()
+
+        def wakeup(self):
+            with self.commands_lock:
+                if self.accepting:
+                    os.write(self.wakeup_w, b"\0")
+
+        def run_commands(self):
+            os.read(self.wakeup_r, 4096)
+            while self.commands:
+                fn, future = self.commands.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn())
+                except Exception as e:
+                    future.set_exception(e)
+
+        def stop(self):
+            with self.commands_lock:
+                if not self.accepting:
+                    return
+                self.accepting = False
+                pending = list(self.commands)
+                self.commands.clear()
+                os.close(self.wakeup_r)
+                os.close(self.wakeup_w)
+            for fn, future in pending:
+                future.set_exception(btle.BTLEDisconnectError("BLE thread stopped"))
+
+        def serve_peripheral(self):
+            """Wait for notifications or commands, then handle them"""
+            perip = self.session.perip
+            helper = perip._helper if perip else None
+            if helper is None:
+                raise btle.BTLEDisconnectError("BLE peripheral disconnected")
+            readable = select.select([helper.stdout, self.wakeup_r],
+                                     [], [], 1.0)[0]
+            with self.session.lock:
+                if self.wakeup_r in readable:
+                    self.run_commands()
+                # The peripheral may have been released meanwhile
+                if helper.stdout in readable and self.session.perip is perip:
+                    perip.waitForNotifications(0.001)
 
         def run(self):
-            while True:
+            try:
+                self.loop()
+            finally:
+                self.stop()
+
+        def loop(self):
+            while self.session.status != self.session.DONE:
                 logger.debug("loop in BLE thread")
-                if self.session.status == self.session.DISCOVERY:
-                    logger.debug("send out found devices")
-                    devices = self.session.found_devices
-                    for d in devices:
-                        params = { 'rssi': d.rssi }
-                        params['peripheralId'] = devices.index(d)
-                        params['name'] = d.getValueText(0x9)
-                        self.session.notify('didDiscoverPeripheral', params)
-                    time.sleep(1)
-                elif self.session.status == self.session.CONNECTED:
+                if self.session.status == self.session.CONNECTED:
                     logger.debug("in connected status:")
-                    delegate = self.session.delegate
-                    if delegate and len(delegate.handles) > 0:
-                        if not delegate.restart_notification_event.is_set():
-                            delegate.restart_notification_event.wait()
-                        try:
-                            self.session.lock.acquire()
-                            self.session.perip.waitForNotifications(1.0)
-                            self.session.lock.release()
-                        except Exception as e:
+                    try:
+                        self.serve_peripheral()
+                    except Exception as e:
+                        if self.session.status != self.session.DONE:
                             logger.error(e)
                             self.session.close()
-                            break
-                    else:
-                        time.sleep(0.0)
-                    # To avoid repeated lock by this single thread,
-                    # yield CPU to other lock waiting threads.
-                    time.sleep(0)
+                        break
                 else:
                     # Nothing to do:
                     time.sleep(1)
 
-    class BLEDelegate(DefaultDelegate):
+    class BLEDelegate():
         """
         A bluepy handler to receive notifictions from BLE devices.
         """
         def __init__(self, session):
-            DefaultDelegate.__init__(self)
             self.session = session
+            # handle -> callable sending data to Scratch
             self.handles = {}
-            self.restart_notification_event = threading.Event()
-            self.restart_notification_event.set()
+            # characteristic ID -> NotificationThrottle
+            self.throttles = {}
+            # handle -> characteristic ID, to record notifications
+            self.chara_ids = {}
 
         def add_handle(self, serviceId, charId, handle):
             logger.debug(f"add handle for notification: {handle}")
-            params = { 'serviceId': UUID(serviceId).getCommonName(),
+            params = { 'serviceId': btle.UUID(serviceId).getCommonName(),
                        'characteristicId': charId,
                        'encoding': 'base64' }
-            self.handles[handle] = params
+            template = NotificationTemplate(
+                'characteristicDidChange', params, 'message')
+            self.chara_ids[handle] = charId
+            policy = self.session.notification_policy(serviceId, charId)
+            if policy.passes_all():
+                self.handles[handle] = functools.partial(
+                    self.session.send_data, template, key=handle)
+                return
+            throttle = NotificationThrottle(self.session, template, handle,
+                                            policy)
+            self.throttles[charId] = throttle
+            self.handles[handle] = throttle.notify
 
         def handleNotification(self, handle, data):
-            logger.debug(f"BLE notification: {handle} {data}")
-            if not self.restart_notification_event.is_set():
+            logger.debug("BLE notification: %s %s", handle, data)
+            if handle == self.session.service_changed_handle:
+                logger.info("GATT services changed, invalidate cache")
+                self.session.gatt_cache.invalidate(self.session.perip.addr,
+                                                   forget=True)
                 return
-            params = self.handles[handle]
-            params['message'] = base64.standard_b64encode(data).decode('ascii')
-            self.session.notify('characteristicDidChange', params)
+            send = self.handles.get(handle)
+            if send is None:
+                return
+            if self.session.recorder:
+                self.session.record(TraceRecorder.BLE_NOTIFY,
+                                    TraceRecorder.chara_payload(
+                                        self.chara_ids[handle], data))
+            send(data)
 
     def __init__(self, websocket, loop):
         super().__init__(websocket, loop)
         self.status = self.INITIAL
+        self.discovery_filter = None
         self.found_devices = []
+        self.peripheral_ids = {}
+        self.reported_rssi = {}
         self.device = None
         self.perip = None
         self.delegate = None
+        self.service_changed_handle = None
+        self.helper_fd = None
+        self.ble_thread = None
+        self.mtu = self.DEFAULT_MTU
+        self.write_latency = LatencyRecorder()
+        self.write_scheduler = None
+        if self.coalesce_writes:
+            self.write_scheduler = WriteScheduler(self,
+                                                  self.max_writes_in_flight)
+
+    def run_device(self, fn, *args):
+        """
+        Run a bluepy call on the peripheral. When the BLE thread owns the
+        peripheral, it runs the call; otherwise take the session lock.
+        """
+        start = time.perf_counter()
+        def timed():
+            self.observe_lock_wait(time.perf_counter() - start)
+            return fn(*args)
+        thread = self.ble_thread
+        if thread and thread.accepting:
+            return thread.submit(timed)
+        with self.lock:
+            return timed()
+
+    def scan_failed(self, e):
+        """Scratch cannot tell a failed scan from silence, so end the session"""
+        self.abort(f"BLE scan failed: {e}")
+
+    def on_scan(self, dev):
+        """
+        Notify a scanned device matching the filters. A device keeps the
+        peripheral ID it got first. Later advertisements are notified only
+        when the RSSI changed meaningfully.
+        """
+        if (self.status != self.DISCOVERY or
+            not self.discovery_filter.matches(dev)):
+            return
+        peripheral_id = self.peripheral_ids.get(dev.addr)
+        if peripheral_id is None:
+            peripheral_id = len(self.found_devices)
+            self.found_devices.append(dev)
+            self.peripheral_ids[dev.addr] = peripheral_id
+        else:
+            last_rssi = self.reported_rssi[peripheral_id]
+            if abs(dev.rssi - last_rssi) < self.rssi_threshold:
+                return
+        self.reported_rssi[peripheral_id] = dev.rssi
+        params = { 'rssi': dev.rssi }
+        params['peripheralId'] = peripheral_id
+        params['name'] = dev.getValueText(0x9)
+        try:
+            # The scanner thread serves all sessions: never wait for one
+            self.notify('didDiscoverPeripheral', params, key=peripheral_id,
+                        block=False)
+        except ConnectionError as e:
+            logger.error(e)
+            self.scanner.unsubscribe(self.on_scan)
+
+    def add_helper_reader(self):
+        """Watch the bluepy helper output with the event loop"""
+        if self.status != self.CONNECTED or self.perip._helper is None:
+            return
+        self.helper_fd = self.perip._helper.stdout.fileno()
+        self.loop.add_reader(self.helper_fd, self.on_helper_readable)
+
+    def remove_helper_reader(self):
+        if self.helper_fd is not None:
+            self.loop.remove_reader(self.helper_fd)
+            self.helper_fd = None
+
+    def on_helper_readable(self):
+        if not self.lock.acquire(blocking=False):
+            # A request is talking to the helper and dispatches
+            # notifications while it waits for its response.
+            self.remove_helper_reader()
+            self.loop.call_later(0.005, self.add_helper_reader)
+            return
+        try:
+            self.perip.waitForNotifications(0.001)
+        except Exception as e:
+            logger.error(e)
+            self.remove_helper_reader()
+            self.close()
+        finally:
+            self.lock.release()
 
     def close(self):
+        connected = self.status == self.CONNECTED
         self.status = self.DONE
-        if self.perip:
-            logger.info(f"disconnect to BLE peripheral: {self.perip}")
-            self.perip.disconnect()
-
-    def __del__(self):
-        self.close()
-
-    def matches(self, dev, filters):
-        """
-        Check if the found BLE device mathces the filters Scracth specifies.
-        """
-        logger.debug(f"in matches {dev} {filters}")
-        for f in filters:
-            if 'services' in f:
-                for s in f['services']:
-                    logger.debug(f"sevice to check: {s}")
-                    given_uuid = s
-                    logger.debug(f"given: {given_uuid}")
-                    service_class_uuid = dev.getValueText(self.ADTYPE_COMP_128B)
-                    logger.debug(f"adtype 128b: {service_class_uuid}")
-                    if not service_class_uuid:
-                        service_class_uuid = dev.getValueText(self.ADTYPE_COMP_16B)
-                        logger.debug(f"adtype 16b: {service_class_uuid}")
-                        if not service_class_uuid:
-                            continue
-                    dev_uuid = UUID(service_class_uuid)
-                    logger.debug(f"dev: {dev_uuid}")
-                    logger.debug(given_uuid == dev_uuid)
-                    if given_uuid == dev_uuid:
-                        logger.debug("match...")
-                        return True
-            if 'name' in f or 'manufactureData' in f:
-                logger.error("name/manufactureData filters not implemented")
-                # TODO: implement other filters defined:
-                # ref: https://github.com/LLK/scratch-link/blob/develop/Documentation/BluetoothLE.md
-        return False
+        self.scanner.unsubscribe(self.on_scan)
+        if self.ble_thread:
+            self.ble_thread.wakeup()
+        if self.write_latency.count:
+            logger.info(f"BLE write latency: {self.write_latency}, "
+                        f"lock wait: {self.lock_wait}")
+            if self.write_scheduler:
+                logger.info(f"BLE write scheduler: {self.write_scheduler.stats()}")
+            self.write_latency = LatencyRecorder()
+        if self.helper_fd is not None:
+            self.call_in_loop(self.remove_helper_reader, wait=True)
+        with self.lock:
+            perip, self.perip = self.perip, None
+            if not perip:
+                return
+            self.gatt_cache.invalidate(perip.addr)
+            if connected and self.pool and self.release_to_pool(perip):
+                return
+            logger.info(f"disconnect to BLE peripheral: {perip}")
+            self.disconnect(perip)
+
+    @classmethod
+    def disconnect(cls, perip):
+        """Disconnect the peripheral and uncount it on its adapter"""
+        try:
+            perip.disconnect()
+        finally:
+            if cls.adapters:
+                cls.adapters.release(perip.iface)
+
+    def connect_peripheral(self, device):
+        """
+        Connect to the device through the adapter the scheduler chooses.
+        Return None when it fails.
+        """
+        iface = None
+        if self.adapters:
+            iface = self.adapters.acquire()
+            if iface is None:
+                logger.error("no BLE adapter has room for another connection")
+                return None
+        try:
+            perip = btle.Peripheral(device.addr, device.addrType, iface)
+        except btle.BTLEDisconnectError as e:
+            logger.error(f"failed to connect to BLE device: {e}")
+            if self.adapters:
+                self.adapters.release(iface)
+            return None
+        logger.info(f"connect to BLE peripheral: {perip}" +
+                    (f" on hci{iface}" if iface is not None else ""))
+        return perip
+
+    def release_to_pool(self, perip):
+        """
+        Stop notifications and keep the peripheral in the pool.
+        Return False when it cannot be kept.
+        """
+        try:
+            perip.withDelegate(None)
+            for handle in self.delegate.handles:
+                perip.writeCharacteristic(handle + 1, b"\x00\x00", True)
+        except btle.BTLEException as e:
+            logger.error(f"failed to stop notifications: {e}")
+            return False
+        self.pool.release(('ble', perip.addr.lower()), perip, self.device,
+                          functools.partial(self.disconnect, perip))
+        return True
+
+    def acquire_from_pool(self, device):
+        """Return a kept peripheral for the device if it is still connected"""
+        pooled = self.pool.acquire(('ble', device.addr.lower()))
+        if not pooled:
+            return None
+        perip = pooled[0]
+        try:
+            if perip.getState() == 'conn':
+                return perip
+        except btle.BTLEException as e:
+            logger.error(f"pooled BLE peripheral is unusable: {e}")
+        self.disconnect(perip)
+        return None
+
+    def negotiate_mtu(self, perip):
+        """
+        Exchange the ATT MTU with the peripheral and return the MTU agreed.
+        A peripheral kept in the pool keeps the MTU of its connection.
+        """
+        mtu = getattr(perip, 'negotiated_mtu', None)
+        if mtu:
+            return mtu
+        mtu = self.DEFAULT_MTU
+        if self.request_mtu > mtu:
+            try:
+                resp = perip.setMTU(self.request_mtu)
+                mtu = min(resp.get('mtu', [mtu])[0], self.request_mtu)
+            except btle.BTLEException as e:
+                logger.info(f"MTU exchange failed, keep {mtu}: {e}")
+        perip.negotiated_mtu = mtu
+        return mtu
+
+    def write_chunks(self, c, data, with_response):
+        """Write data in as many writes as the MTU needs"""
+        size = self.mtu - 3
+        for i in range(0, len(data), size):
+            c.write(data[i:i + size], with_response)
+
+    def prepare_gatt_cache(self):
+        """
+        Fill the GATT cache for the connected peripheral and subscribe to
+        service changed indications to know when the cache gets stale.
+        """
+        with self.lock:
+            self.gatt_cache.fill(self.perip)
+            handle = self.gatt_cache.service_changed_handle(self.perip.addr)
+            if handle is None:
+                return
+            try:
+                self.perip.writeCharacteristic(handle + 1, b"\x02\x00", True)
+                self.service_changed_handle = handle
+            except btle.BTLEException as e:
+                logger.debug(f"service changed indication unavailable: {e}")
+
+    def threads(self):
+        return [self.ble_thread] if self.ble_thread else []
+
+    @classmethod
+    def notification_policy(cls, service_id, chara_id):
+        """Return the policy for the characteristic, then its service"""
+        policies = cls.notification_policies
+        for key in (chara_id, service_id):
+            policy = policies.get(btle.UUID(key))
+            if policy:
+                return policy
+        return policies.get('*') or NotificationPolicy()
+
+    def stats(self):
+        stats = super().stats()
+        stats['write_latency'] = self.write_latency.summary()
+        perip = self.perip
+        stats['adapter'] = perip.iface if perip else None
+        stats['mtu'] = self.mtu
+        if self.write_scheduler:
+            stats['write_scheduler'] = self.write_scheduler.stats()
+        delegate = self.delegate
+        if delegate and delegate.throttles:
+            stats['notifications'] = { chara_id: throttle.stats()
+                                       for chara_id, throttle
+                                       in delegate.throttles.items() }
+        return stats
+
+    def write_characteristic(self, service_id, chara_id, data,
+                             with_response=False):
+        """
+        Write data to a characteristic.
+        Return False when the peripheral does not have it.
+        """
+        start = time.perf_counter()
+        c = self.run_device(self.gatt_cache.lookup, self.perip,
+                            service_id, chara_id)
+        if c is None:
+            logger.error(f"Failed to get characteristic {chara_id}")
+            return False
+        if self.chunk_writes and len(data) > self.mtu - 3:
+            self.run_device(self.write_chunks, c, data, with_response)
+        else:
+            self.run_device(c.write, data, with_response)
+        self.write_latency.add(time.perf_counter() - start)
+        if self.recorder:
+            self.record(TraceRecorder.BLE_WRITE,
+                        TraceRecorder.chara_payload(chara_id, data))
+        return True
+
+    def defer_request(self, method, params):
+        if not (self.write_scheduler and self.status == self.CONNECTED and
+                method == 'write'):
+            return None
+        data = self.decode_message(params)
+        future = self.write_scheduler.submit(
+            params['serviceId'], params['characteristicId'], data,
+            params.get('withResponse', False))
+        return self.write_result(future, len(data))
+
+    async def write_result(self, future, length):
+        await future
+        return { "jsonrpc": "2.0", "result": length }
 
     def handle_request(self, method, params):
         """Handle requests from Scratch"""
-        if self.delegate:
-            # Do not allow notification during request handling to avoid
-            # websocket server errors
-            self.delegate.restart_notification_event.clear()
-
         logger.debug("handle request to BLE device")
         logger.debug(method)
         if len(params) > 0:
@@ -434,37 +2843,40 @@ class BLESession(Session):
         res = { "jsonrpc": "2.0" }
 
         if self.status == self.INITIAL and method == 'discover':
-            scanner = Scanner()
-            devices = scanner.scan(1.0)
-            for dev in devices:
-                if self.matches(dev, params['filters']):
-                    self.found_devices.append(dev)
-            if len(self.found_devices) == 0:
-                err_msg = f"BLE service not found for {params['filters']}"
-                res["error"] = { "message": err_msg }
-                self.status = self.DONE
-            else:
-                res["result"] = None
-                self.status = self.DISCOVERY
-                self.ble_thread = self.BLEThread(self)
-                self.ble_thread.start()
+            self.discovery_filter = DiscoveryFilter(params['filters'])
+            self.status = self.DISCOVERY
+            # Pooled peripherals are connected and do not advertise
+            if self.pool:
+                for addr, dev in self.pool.available('ble'):
+                    self.on_scan(dev)
+            self.scanner.subscribe(self.on_scan, self.scan_failed)
+            res["result"] = None
 
         elif self.status == self.DISCOVERY and method == 'connect':
             logger.debug("connecting to the BLE device")
+            self.scanner.unsubscribe(self.on_scan)
             self.device = self.found_devices[params['peripheralId']]
-            try:
-                self.perip = Peripheral(self.device.addr,
-                                        self.device.addrType)
-                logger.info(f"connect to BLE peripheral: {self.perip}")
-            except BTLEDisconnectError as e:
-                logger.error(f"failed to connect to BLE device: {e}")
-                self.status = self.DONE
+            if self.pool:
+                self.perip = self.acquire_from_pool(self.device)
+            if not self.perip:
+                self.perip = self.connect_peripheral(self.device)
 
             if self.perip:
                 res["result"] = None
                 self.status = self.CONNECTED
                 self.delegate = self.BLEDelegate(self)
                 self.perip.withDelegate(self.delegate)
+                if self.io_backend == 'thread':
+                    self.ble_thread = self.BLEThread(self)
+                    self.ble_thread.start()
+                try:
+                    self.mtu = self.run_device(self.negotiate_mtu, self.perip)
+                    logger.info(f"ATT MTU {self.mtu} for {self.perip.addr}")
+                    self.run_device(self.prepare_gatt_cache)
+                except btle.BTLEException as e:
+                    logger.error(f"failed to prepare GATT cache: {e}")
+                if self.io_backend == 'asyncio':
+                    self.call_in_loop(self.add_helper_reader)
             else:
                 err_msg = f"BLE connect failed :{self.device}"
                 res["error"] = { "message": err_msg }
@@ -474,88 +2886,746 @@ class BLESession(Session):
             logger.debug("handle read request")
             service_id = params['serviceId']
             chara_id = params['characteristicId']
-            charas = self.perip.getCharacteristics(uuid=chara_id)
-            c = charas[0]
-            if c.uuid != UUID(chara_id):
-                logger.error("Failed to get characteristic {chara_id}")
+            c = self.run_device(self.gatt_cache.lookup, self.perip,
+                                service_id, chara_id)
+            if c is None:
+                logger.error(f"Failed to get characteristic {chara_id}")
                 self.status = self.DONE
             else:
-                self.lock.acquire()
-                b = c.read()
-                self.lock.release()
+                b = self.run_device(c.read)
+                if self.recorder:
+                    self.record(TraceRecorder.BLE_READ,
+                                TraceRecorder.chara_payload(chara_id, b))
                 message = base64.standard_b64encode(b).decode('ascii')
                 res['result'] = { 'message': message, 'encode': 'base64' }
-            if params['startNotifications'] == True:
-                logger.debug(f"start notification for {chara_id}")
-                service = self.perip.getServiceByUUID(UUID(service_id))
-                chas = service.getCharacteristics(forUUID=chara_id)
-                handle = chas[0].getHandle()
-                # prepare notification handler
-                self.delegate.add_handle(service_id, chara_id, handle)
-                # request notification to the BLE device
-                self.lock.acquire()
-                self.perip.writeCharacteristic(chas[0].getHandle() + 1,
-                                               b"\x01\x00", True)
-                self.lock.release()
+                if params.get('startNotifications') == True:
+                    logger.debug(f"start notification for {chara_id}")
+                    handle = c.getHandle()
+                    # prepare notification handler
+                    self.delegate.add_handle(service_id, chara_id, handle)
+                    # request notification to the BLE device
+                    self.run_device(self.perip.writeCharacteristic,
+                                    handle + 1, b"\x01\x00", True)
 
         elif self.status == self.CONNECTED and method == 'write':
             logger.debug("handle write request")
-            service_id = params['serviceId']
-            chara_id = params['characteristicId']
-            charas = self.perip.getCharacteristics(uuid=chara_id)
-            c = charas[0]
-            if c.uuid != UUID(chara_id):
-                logger.error("Failed to get characteristic {chara_id}")
-                self.status = self.DONE
-            else:
-                if params['encoding'] != 'base64':
-                    logger.error("encoding other than base 64 is not "
-                                 "yet supported: ", params['encoding'])
-                msg_bstr = params['message'].encode('ascii')
-                data = base64.standard_b64decode(msg_bstr)
-                self.lock.acquire()
-                c.write(data)
-                self.lock.release()
+            data = self.decode_message(params)
+            if self.write_characteristic(params['serviceId'],
+                                         params['characteristicId'], data,
+                                         params.get('withResponse', False)):
                 res['result'] = len(data)
+            else:
+                self.status = self.DONE
 
         logger.debug(res)
         return res
 
     def end_request(self):
         logger.debug("end_request of BLESession")
-        if self.delegate:
-            self.delegate.restart_notification_event.set()
         return self.status == self.DONE
 
-# kick start WSS server
-ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-localhost_pem = pathlib.Path(__file__).with_name("scratch-device-manager.pem")
-ssl_context.load_cert_chain(localhost_pem)
-sessionTypes = { '/scratch/ble': BLESession, '/scratch/bt': BTSession }
+class WorkerChannel():
+    """
+    Messages between the main process and a worker process over a
+    socketpair: a header with the payload length, the message type and
+    the session id, followed by the payload. Requests, responses and
+    notifications are pickled; device data is sent as raw bytes after
+    the id of its notification template.
+    """
+    HEADER = struct.Struct("!IBI")
+    DATA_HEADER = struct.Struct("!H?")
+
+    OPEN = 1        # main -> worker: websocket path
+    REQUEST = 2     # main -> worker: request dict
+    RESPONSE = 3    # worker -> main: response dict
+    NOTIFY = 4      # worker -> main: (method, params, key)
+    TEMPLATE = 5    # worker -> main: (template id, prefix, suffix)
+    DATA = 6        # worker -> main: DATA_HEADER and device bytes
+    CLOSE = 7       # both ways: the session is over
+
+    @classmethod
+    def frame(cls, msg_type, session_id, payload=b""):
+        return cls.HEADER.pack(len(payload), msg_type, session_id) + payload
+
+class WorkerSession():
+    """
+    Mixin running the device side of a RemoteSession in a worker process.
+    Requests arrive as dicts with raw message bytes. Responses,
+    notifications and device data go back over the channel, leaving JSON
+    and base64 to the main process.
+    """
+    def __init__(self, worker, session_id, loop):
+        self.worker = worker
+        self.session_id = session_id
+        self.requests = asyncio.Queue()
+        self.template_ids = {}
+        super().__init__(None, loop)
+
+    async def recv_jsonreq(self):
+        jsonreq = await self.requests.get()
+        if jsonreq is None:
+            raise ConnectionError("session closed by the main process")
+        return jsonreq
+
+    def close_websocket(self, reason):
+        # Ending the handler sends CLOSE, which closes the websocket
+        self.requests.put_nowait(None)
+
+    async def send_jsonres(self, jsonres):
+        self.worker.send(WorkerChannel.RESPONSE, self.session_id,
+                         pickle.dumps(jsonres, pickle.HIGHEST_PROTOCOL))
+
+    def decode_message(self, params):
+        return params['message']
+
+    def notify(self, method, params, key=None, block=True):
+        self.worker.send(WorkerChannel.NOTIFY, self.session_id,
+                         pickle.dumps((method, params, key, block),
+                                      pickle.HIGHEST_PROTOCOL))
+
+    def send_data(self, template, data, key=None):
+        template_id = self.template_ids.get(template)
+        if template_id is None:
+            template_id = self.template_ids[template] = len(self.template_ids)
+            self.worker.send(WorkerChannel.TEMPLATE, self.session_id,
+                             pickle.dumps((template_id, template.prefix,
+                                           template.suffix)))
+        self.worker.send(WorkerChannel.DATA, self.session_id,
+                         WorkerChannel.DATA_HEADER.pack(template_id,
+                                                        key is not None) + data)
+
+class Worker():
+    """Serve the device side of sessions in a worker process"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.sessions = {}
+        self.tasks = set()
+        self.loop = None
+        self.stopped = None
+
+    def send(self, msg_type, session_id, payload=b""):
+        """
+        Send a message to the main process from any thread.
+        Raise ConnectionError when the main process is gone.
+        """
+        try:
+            with self.send_lock:
+                self.sock.sendall(
+                    WorkerChannel.frame(msg_type, session_id, payload))
+        except OSError as e:
+            raise ConnectionError(f"main process is gone: {e}")
+
+    def recv_exactly(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        while view:
+            n = self.sock.recv_into(view)
+            if n == 0:
+                raise ConnectionError("main process is gone")
+            view = view[n:]
+        return bytes(buf)
+
+    def read(self):
+        """Read messages on a thread and handle them on the event loop"""
+        try:
+            while True:
+                length, msg_type, session_id = WorkerChannel.HEADER.unpack(
+                    self.recv_exactly(WorkerChannel.HEADER.size))
+                payload = self.recv_exactly(length)
+                self.loop.call_soon_threadsafe(self.dispatch, msg_type,
+                                               session_id, payload)
+        except OSError as e:
+            logger.info(f"worker {os.getpid()} stops: {e}")
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def dispatch(self, msg_type, session_id, payload):
+        if msg_type == WorkerChannel.OPEN:
+            session_type = backends.worker_type(payload.decode('utf-8'))
+            session = session_type(self, session_id, self.loop)
+            self.sessions[session_id] = session
+            task = asyncio.create_task(self.run_session(session_id, session))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        if msg_type == WorkerChannel.REQUEST:
+            session.requests.put_nowait(pickle.loads(payload))
+        elif msg_type == WorkerChannel.CLOSE:
+            session.requests.put_nowait(None)
+
+    async def run_session(self, session_id, session):
+        try:
+            await session.handle()
+        except Exception as e:
+            logger.debug(f"worker session {session_id} ended: {e}")
+        finally:
+            self.sessions.pop(session_id, None)
+            try:
+                self.send(WorkerChannel.CLOSE, session_id)
+            except ConnectionError:
+                pass
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        threading.Thread(target=self.read, name="worker-channel",
+                         daemon=True).start()
+        await self.stopped.wait()
+        for session in list(self.sessions.values()):
+            session.requests.put_nowait(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+def worker_main(sock, args, adapters=None):
+    """Entry point of a worker process"""
+    args.workers = 0
+    args.worker_per_adapter = False
+    # The main process records the websocket side of sessions
+    args.record = None
+    if adapters is not None:
+        args.adapters = adapters
+    configure(args)
+    logger.info(f"worker {os.getpid()} started")
+    asyncio.run(Worker(sock).run())
+    # Device threads of closed sessions must not keep the worker alive
+    os._exit(0)
+
+class WorkerProcess():
+    """A worker process as seen from the main process"""
+    def __init__(self, pool, index, adapters=None):
+        self.pool = pool
+        self.index = index
+        self.adapters = adapters
+        self.process = None
+        self.writer = None
+        self.alive = False
+        self.sessions = {}
+        self.next_session_id = 0
+
+    async def start(self):
+        parent, child = socket.socketpair()
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(
+            target=self.pool.target, args=(child, self.pool.args, self.adapters),
+            name=f"scratch-link-worker-{self.index}", daemon=True)
+        self.process.start()
+        child.close()
+        reader, self.writer = await asyncio.open_connection(sock=parent)
+        self.alive = True
+        asyncio.create_task(self.read(reader))
+        logger.info(f"started worker {self.index}: pid {self.process.pid}")
+
+    def send(self, msg_type, session_id, payload=b""):
+        """Send a message to the worker. Call on the event loop thread."""
+        if self.alive:
+            self.writer.write(WorkerChannel.frame(msg_type, session_id,
+                                                  payload))
+
+    def open(self, session, path):
+        self.next_session_id += 1
+        session_id = self.next_session_id
+        self.sessions[session_id] = session
+        self.send(WorkerChannel.OPEN, session_id, path.encode('utf-8'))
+        return session_id
+
+    def close_session(self, session_id):
+        if self.sessions.pop(session_id, None):
+            self.send(WorkerChannel.CLOSE, session_id)
+
+    async def read(self, reader):
+        header = WorkerChannel.HEADER
+        try:
+            while True:
+                length, msg_type, session_id = header.unpack(
+                    await reader.readexactly(header.size))
+                payload = await reader.readexactly(length) if length else b""
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue
+                if msg_type == WorkerChannel.CLOSE:
+                    del self.sessions[session_id]
+                session.on_worker_message(msg_type, payload)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.debug(f"worker {self.index} channel closed: {e}")
+        finally:
+            self.alive = False
+            self.writer.close()
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            for session in sessions:
+                session.worker_lost()
+            if not self.pool.closing:
+                asyncio.create_task(self.pool.restart(self))
+
+class WorkerPool():
+    """
+    Worker processes running the device side of sessions, one per adapter
+    or a fixed number. Sessions in different workers do not contend for
+    one GIL, and a wedged device call only stalls the sessions of its
+    worker. Each session goes to the worker with the fewest sessions.
+    Workers that exit are restarted.
+    """
+    restart_delay = 1.0
+
+    def __init__(self, args, count=1, adapters=None, target=None):
+        self.args = args
+        # Replaced by benchmarks to run workers with fake devices
+        self.target = target or worker_main
+        self.closing = False
+        self.restarts = 0
+        if adapters:
+            self.workers = [WorkerProcess(self, i, [adapter])
+                            for i, adapter in enumerate(adapters)]
+        else:
+            self.workers = [WorkerProcess(self, i) for i in range(count)]
+        metrics.add_collector(self.gauges)
+
+    async def start(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+
+    def place(self):
+        """Return the worker for a new session"""
+        workers = [worker for worker in self.workers if worker.alive]
+        if not workers:
+            raise ConnectionError("no worker process is running")
+        return min(workers, key=lambda worker: len(worker.sessions))
+
+    async def restart(self, worker):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, worker.process.join)
+        logger.error(f"worker {worker.index} exited with "
+                     f"{worker.process.exitcode}, restarting")
+        self.restarts += 1
+        metrics.inc('scratch_link_worker_restarts_total')
+        await asyncio.sleep(self.restart_delay)
+        if not self.closing:
+            await worker.start()
+
+    def close(self):
+        self.closing = True
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+
+    def gauges(self):
+        return { 'scratch_link_worker_sessions':
+                     [((('worker', str(worker.index)),), len(worker.sessions))
+                      for worker in self.workers] }
+
+    def stats(self):
+        return { 'restarts': self.restarts,
+                 'workers': [{ 'pid': worker.process.pid if worker.process
+                                      else None,
+                               'alive': worker.alive,
+                               'sessions': len(worker.sessions) }
+                             for worker in self.workers] }
+
+class RemoteSession(Session):
+    """
+    Session terminating the websocket in the main process while its
+    device side runs in a worker process. JSON and base64 are handled
+    here: the worker gets requests with raw message bytes and sends
+    device data raw.
+    """
+    def __init__(self, websocket, loop, session_type, path):
+        self.kind = session_type.kind
+        self.methods = session_type.methods
+        super().__init__(websocket, loop)
+        self.templates = {}
+        # request sequence number -> (JSON-RPC id, method, start time)
+        self.pending = {}
+        self.seq = 0
+        self.done = False
+        self.worker = self.workers.place()
+        self.session_id = self.worker.open(self, path)
+
+    async def recv_request(self):
+        try:
+            jsonreq = await self.recv_jsonreq()
+        except websockets.ConnectionClosed:
+            if self.done:
+                return True
+            raise
+        if jsonreq['jsonrpc'] != '2.0':
+            logger.error("error: jsonrpc versino is not 2.0")
+            return False
+        params = jsonreq.get('params') or {}
+        if (isinstance(params.get('message'), str) and
+            params.get('encoding', 'base64') == 'base64'):
+            params['message'] = base64.standard_b64decode(params['message'])
+        self.request_count += 1
+        if (jsonreq['method'] == 'connect' and
+            not self.supervisor.connect(self)):
+            return await self.respond(jsonreq, self.too_many_connections())
+        self.seq += 1
+        self.pending[self.seq] = (jsonreq.get('id'), jsonreq['method'],
+                                  time.perf_counter())
+        jsonreq['id'] = self.seq
+        self.worker.send(WorkerChannel.REQUEST, self.session_id,
+                         pickle.dumps(jsonreq, pickle.HIGHEST_PROTOCOL))
+        return False
+
+    def on_worker_message(self, msg_type, payload):
+        try:
+            if msg_type == WorkerChannel.DATA:
+                template_id, keyed = WorkerChannel.DATA_HEADER.unpack_from(
+                    payload)
+                prefix, suffix = self.templates[template_id]
+                message = base64.standard_b64encode(
+                    memoryview(payload)[WorkerChannel.DATA_HEADER.size:])
+                self.send_notification(
+                    prefix + message.decode('ascii') + suffix,
+                    template_id if keyed else None)
+            elif msg_type == WorkerChannel.RESPONSE:
+                self.on_response(pickle.loads(payload))
+            elif msg_type == WorkerChannel.NOTIFY:
+                self.notify(*pickle.loads(payload))
+            elif msg_type == WorkerChannel.TEMPLATE:
+                template_id, prefix, suffix = pickle.loads(payload)
+                self.templates[template_id] = (prefix, suffix)
+            elif msg_type == WorkerChannel.CLOSE:
+                self.worker_lost()
+        except ConnectionError:
+            # The websocket is gone, the session is ending
+            pass
+
+    def on_response(self, jsonres):
+        entry = self.pending.pop(jsonres.pop('id', None), None)
+        if entry:
+            jsonreq_id, method, start = entry
+            if method == self.STATS_METHOD and 'result' in jsonres:
+                jsonres['result'] = self.merge_stats(jsonres['result'])
+            else:
+                self.observe_request(method, time.perf_counter() - start)
+            if method == 'connect':
+                self.supervisor.connect_done(self, jsonres)
+            if jsonreq_id is not None:
+                jsonres['id'] = jsonreq_id
+        task = asyncio.create_task(self.send_jsonres(jsonres))
+        self.deferred_tasks.add(task)
+        task.add_done_callback(self.deferred_tasks.discard)
+
+    def merge_stats(self, result):
+        """
+        Complete the getStats result of the worker, which knows the device
+        side of the session, with the websocket side and the metrics of
+        this process. The worker's metrics are kept under 'worker'.
+        """
+        session = dict(result.get('session', {}))
+        local = self.stats()
+        for key in ('type', 'requests', 'send_queue'):
+            session[key] = local[key]
+        return { 'session': session,
+                 'global': metrics.snapshot(),
+                 'worker': result.get('global', {}) }
+
+    def worker_lost(self):
+        """End the session when the worker ended it or exited"""
+        self.done = True
+        task = asyncio.create_task(self.websocket.close())
+        self.deferred_tasks.add(task)
+        task.add_done_callback(self.deferred_tasks.discard)
+
+    def close(self):
+        self.call_in_loop(self.worker.close_session, self.session_id)
+
+class BackendRegistry():
+    """
+    Session types by websocket path. A backend registers a loader which
+    imports what the backend needs and returns its session class, so a
+    backend costs nothing until the first session on its path.
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.types = {}
+        self.worker_types = {}
+
+    def register(self, path, loader):
+        """Serve sessions on path with the session class loader returns"""
+        self.loaders[path] = loader
+        self.types.pop(path, None)
+        self.worker_types.pop(path, None)
+
+    def session_type(self, path):
+        """
+        Return the session class for path, loading its backend on first
+        use. Raise KeyError for paths without a backend.
+        """
+        session_type = self.types.get(path)
+        if session_type is None:
+            start = time.perf_counter()
+            session_type = self.types[path] = self.loaders[path]()
+            logger.info(f"loaded backend for {path} in "
+                        f"{(time.perf_counter() - start) * 1000:.0f} ms")
+        return session_type
+
+    async def load(self, path):
+        """Return the session class for path, loading it off the event loop"""
+        if path in self.types:
+            return self.types[path]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.session_type, path)
+
+    def worker_type(self, path):
+        """Return the session class running sessions of path in a worker"""
+        worker_type = self.worker_types.get(path)
+        if worker_type is None:
+            session_type = self.session_type(path)
+            worker_type = self.worker_types[path] = type(
+                f"Worker{session_type.__name__}",
+                (WorkerSession, session_type), {})
+        return worker_type
+
+def load_ble():
+    btle.load()
+    return BLESession
+
+def load_bt():
+    bluetooth.load()
+    return BTSession
+
+backends = BackendRegistry()
+backends.register('/scratch/ble', load_ble)
+backends.register('/scratch/bt', load_bt)
+
+def make_ssl_context():
+    """Load the certificate of the local secure websocket server"""
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    localhost_pem = pathlib.Path(__file__).with_name("scratch-device-manager.pem")
+    ssl_context.load_cert_chain(localhost_pem)
+    return ssl_context
 
 async def ws_handler(websocket):
     path = None
+    supervisor = Session.supervisor
+    if not supervisor.admit():
+        logger.error("too many sessions, refuse a new one")
+        await websocket.close(1013, "too many sessions")
+        return
+    session = None
     try:
         path = websocket.request.path
         logger.info(f"Start session for web socket path: {path}")
-        session = sessionTypes[path](websocket, asyncio.get_running_loop())
+        loop = asyncio.get_running_loop()
+        session_type = await backends.load(path)
+        if Session.workers:
+            session = RemoteSession(websocket, loop, session_type, path)
+        else:
+            session = session_type(websocket, loop)
+        supervisor.track(session)
+        if Session.recorder:
+            session.trace_id = Session.recorder.open_session(path)
         await session.handle()
+    except websockets.ConnectionClosed as e:
+        logger.info(f"Session for web socket path {path} closed: {e}")
     except Exception as e:
         logger.error(f"Failure in session for web socket path: {path}")
         logger.error(e)
+    finally:
+        await supervisor.release(session)
+        if session and session.trace_id is not None:
+            Session.recorder.close_session(session.trace_id)
 
-async def main():
+async def metrics_handler(reader, writer):
+    """Answer HTTP GET /metrics with metrics in the Prometheus text format"""
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            status = "200 OK"
+            body = metrics.render().encode('utf-8')
+        else:
+            status = "404 Not Found"
+            body = b""
+        writer.write(f"HTTP/1.1 {status}\r\n"
+                     "Content-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     "Connection: close\r\n\r\n".encode('ascii') + body)
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"failed to serve metrics: {e}")
+    finally:
+        writer.close()
+
+def configure(args):
+    """Configure sessions from the parsed command line"""
+    codec.use(args.json == 'orjson')
+    if args.request_workers > 0:
+        Session.dispatcher = RequestDispatcher(args.request_workers)
+    if args.gatt_cache:
+        BLESession.gatt_cache = GattCache(args.gatt_cache)
+    if args.pool_grace > 0:
+        Session.pool = ConnectionPool(args.pool_grace, args.pool_size)
+    Session.send_queue_size = args.send_queue_size
+    BTSession.batch_frames = args.batch_frames
+    BTSession.send_buffer_size = args.bt_send_buffer
+    BTSession.inquiry.ttl = args.bt_cache_ttl
+    if args.record:
+        Session.recorder = TraceRecorder(args.record, args.record_max_bytes,
+                                         args.record_backups)
+    if args.notify_policy:
+        BLESession.notification_policies = { '*': NotificationPolicy(),
+                                              **dict(args.notify_policy) }
+    supervisor = Session.supervisor
+    supervisor.max_sessions = args.max_sessions
+    supervisor.max_connections = args.max_connections
+    supervisor.idle_timeout = args.idle_timeout
+    supervisor.keepalive = args.keepalive
+    BLESession.coalesce_writes = args.coalesce_writes
+    BLESession.max_writes_in_flight = args.max_writes_in_flight
+    BLESession.request_mtu = args.ble_mtu
+    BLESession.chunk_writes = args.chunk_writes
+    Session.io_backend = args.io_backend
+    Session.send_queue_policy = args.send_queue_policy
+    adapters = args.adapters or AdapterScheduler.detect()
+    if args.adapters or len(adapters) > 1:
+        BLESession.adapters = BLEScanner.adapters = AdapterScheduler(
+            adapters, args.adapter_policy, args.max_connections_per_adapter)
+        logger.info("BLE adapters: " +
+                    ", ".join(f"hci{adapter}" for adapter in adapters))
+    if args.worker_per_adapter:
+        Session.workers = WorkerPool(args, adapters=adapters or [0])
+    elif args.workers > 0:
+        Session.workers = WorkerPool(args, args.workers)
+
+async def main(args):
+    configure(args)
+    if Session.pool:
+        asyncio.create_task(Session.pool.run())
+    if Session.workers:
+        await Session.workers.start()
+    asyncio.create_task(Session.supervisor.run())
+    if args.metrics_port:
+        await asyncio.start_server(metrics_handler, "127.0.0.1",
+                                   args.metrics_port)
+        logger.info(f"serve metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.monitor_loop:
+        monitor = LoopMonitor()
+        asyncio.create_task(monitor.run())
+        asyncio.create_task(monitor.log_periodically(args.monitor_loop))
+    # kick start WSS server
+    ssl_context = make_ssl_context()
     while True:
         try:
             async with websockets.serve(
                 ws_handler,
                 "device-manager.scratch.mit.edu",
                 20110,
-                ssl=ssl_context
+                ssl=ssl_context,
+                **Session.supervisor.serve_options()
             ):
                 await asyncio.Future()  # run forever
         except Exception as e:
             logger.info("restart server...")
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Scratch link on bluepy")
+    parser.add_argument("--request-workers", type=int, default=8,
+                        help="threads to handle blocking device requests; "
+                        "0 handles them on the event loop (default: 8)")
+    parser.add_argument("--monitor-loop", type=float, default=0,
+                        metavar="SECONDS",
+                        help="log event loop stall statistics every SECONDS")
+    parser.add_argument("--json", choices=('orjson', 'json'),
+                        default='orjson',
+                        help="JSON library; orjson is used only when it is "
+                        "installed (default: orjson)")
+    parser.add_argument("--gatt-cache", metavar="FILE",
+                        help="persist GATT layouts of known BLE devices to FILE")
+    parser.add_argument("--pool-grace", type=float, default=0,
+                        metavar="SECONDS",
+                        help="keep device connections for SECONDS after "
+                        "their session ends for reuse (default: 0, off)")
+    parser.add_argument("--pool-size", type=int, default=4,
+                        help="maximum connections kept for reuse (default: 4)")
+    parser.add_argument("--send-queue-size", type=int, default=256,
+                        help="notifications queued per session (default: 256)")
+    parser.add_argument("--send-queue-policy", choices=SendQueue.POLICIES,
+                        default=SendQueue.BLOCK,
+                        help="what to do when the send queue is full "
+                        "(default: block)")
+    parser.add_argument("--batch-frames", action="store_true",
+                        help="send BT frames received together as one message")
+    parser.add_argument("--bt-send-buffer", type=int, default=64 << 10,
+                        help="bytes waiting to be sent to a BT device before "
+                        "further sends fail (default: 65536)")
+    parser.add_argument("--coalesce-writes", action="store_true",
+                        help="write only the latest of queued values for "
+                        "each BLE characteristic")
+    parser.add_argument("--max-writes-in-flight", type=int, default=1,
+                        help="BLE writes in flight per session with "
+                        "--coalesce-writes (default: 1)")
+    parser.add_argument("--ble-mtu", type=int, default=247,
+                        help="ATT MTU to request when connecting to a BLE "
+                        "device, 0 to keep the default of 23 (default: 247)")
+    parser.add_argument("--chunk-writes", action="store_true",
+                        help="split BLE writes longer than the negotiated "
+                        "MTU into several writes")
+    parser.add_argument("--io-backend", choices=Session.IO_BACKENDS,
+                        default='thread',
+                        help="poll devices from a thread per session or "
+                        "watch them with the event loop (default: thread)")
+    parser.add_argument("--adapters", metavar="N,N...",
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        help="HCI adapter numbers to spread BLE connections "
+                        "over (default: all adapters found)")
+    parser.add_argument("--adapter-policy", choices=AdapterScheduler.POLICIES,
+                        default=AdapterScheduler.LEAST_LOADED,
+                        help="how to choose the adapter of a new BLE "
+                        "connection (default: least-loaded)")
+    parser.add_argument("--max-connections-per-adapter", type=int, default=0,
+                        help="BLE connections allowed per adapter "
+                        "(default: 0, no limit)")
+    parser.add_argument("--bt-cache-ttl", type=float, default=60,
+                        help="seconds BT devices found stay reported to new "
+                        "discoveries without an inquiry (default: 60)")
+    parser.add_argument("--notify-policy", action="append",
+                        type=NotificationPolicy.parse, default=[],
+                        metavar="UUID=RATE[,skip-duplicates]",
+                        help="send notifications of a characteristic or "
+                        "service UUID, or * for the others, at most RATE "
+                        "times per second, 0 for no limit; the last value is "
+                        "always sent. With skip-duplicates, unchanged values "
+                        "are not sent again. Repeat for more UUIDs "
+                        "(default: *=0, all notifications are sent)")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record requests, notifications and device "
+                        "traffic of every session to FILE for replay")
+    parser.add_argument("--record-max-bytes", type=int, default=64 << 20,
+                        help="rotate the trace when it gets this large "
+                        "(default: 64 MiB)")
+    parser.add_argument("--record-backups", type=int, default=5,
+                        help="rotated traces to keep (default: 5)")
+    parser.add_argument("--max-sessions", type=int, default=0,
+                        help="refuse sessions beyond this many "
+                        "(default: 0, no limit)")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="fail connect requests beyond this many device "
+                        "connections (default: 0, no limit)")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        metavar="SECONDS",
+                        help="close sessions without a device connection, "
+                        "requests or messages for SECONDS (default: 0, "
+                        "keep them)")
+    parser.add_argument("--keepalive", type=float, default=20,
+                        metavar="SECONDS",
+                        help="ping Scratch every SECONDS and close the "
+                        "session without a pong in as long; 0 disables "
+                        "(default: 20)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run device sessions in this many worker "
+                        "processes (default: 0, in the server process)")
+    parser.add_argument("--worker-per-adapter", action="store_true",
+                        help="run device sessions in a worker process per "
+                        "BLE adapter")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on this local port "
+                        "(default: 0, off)")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file